@@ -17,6 +17,8 @@ setup(
     include_package_data=True,
     zip_safe=False,
     description='web front-end for the doRiNA database',
-    install_requires='rq redis flask dorina daemon'.split(),
+    install_requires=['rq', 'redis>=4.2', 'flask', 'dorina', 'daemon'],
+    extras_require={'asgi': ['starlette', 'asgiref', 'uvicorn'],
+                    'sites': ['numpy']},
     tests_require=['nose']
 )
\ No newline at end of file
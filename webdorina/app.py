@@ -3,21 +3,31 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
 import json
 import logging
 import os
+import signal
 import sys
+import threading
+import time
 import uuid
-from io import BytesIO
+import zlib
 
 import flask
 from dorina.genome import Genome
 from dorina.regulator import Regulator
-from flask import flash, request, redirect, jsonify, render_template, send_file
+from flask import flash, request, redirect, jsonify, render_template, send_file, \
+    Response, stream_with_context
 from redis import Redis
 from rq import Queue
 
-from webdorina.workers import filter_genes, run_analyse
+from webdorina import tissues
+from webdorina.genes import GeneIndex
+from webdorina.results import gene_index_key, make_store, result_key, \
+    sub_queries
+from webdorina.workers import combine_results, filter_genes, run_analyse, \
+    waiters_key
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 app = flask.Flask('webdorina',
@@ -38,9 +48,14 @@ except IndexError:
 Genome.init(app.config['DATA_PATH'])
 Regulator.init(app.config['DATA_PATH'])
 
-conn = Redis(charset="utf-8", decode_responses=True)
+conn = Redis(decode_responses=True)
 # assert redis is running
 conn.ping()
+# result blocks are compressed and rq pickles its jobs, so both need a
+# connection returning bytes
+raw_conn = Redis()
+store = make_store(raw_conn, app.config['RESULT_BACKEND'],
+                   app.config['RESULT_PATH'])
 
 
 def _create_session(create_dir=False):
@@ -55,26 +70,72 @@ def _create_session(create_dir=False):
     return unique_id
 
 
-def _list_genomes():
-    def without_assemblies(h):
-        h1 = h.copy()
-        del h1['assemblies']
-        return h1
+def _touch_result(query_key):
+    """Keep a cached result and its gene index alive"""
+    conn.expire(query_key, app.config['RESULT_TTL'])
+    conn.expire(gene_index_key(query_key), app.config['RESULT_TTL'])
 
-    genome_list = list(map(without_assemblies, Genome.all().values()))
 
-    return genome_list
+def _usable_result(query_key):
+    """Whether a complete, successful result is cached under query_key"""
+    if not store.complete(query_key):
+        return False
+    first = store.read(query_key, 0, 1)
+    return not (first and first[0].startswith('Job failed'))
 
 
-def _list_assemblies():
+def _build_catalogue():
+    """Genomes and assemblies, serialised once for all requests"""
+    genomes = []
     assemblies = []
     for g in list(Genome.all().values()):
+        genome = dict((k, v) for k, v in g.items() if k != 'assemblies')
+        genomes.append(genome)
         for key, val in list(g['assemblies'].items()):
-            val['id'] = key
-            val['weight'] = int(key[2:])
-            val['genome'] = g['id']
-            assemblies.append(val)
-    return assemblies
+            assembly = dict(val, id=key, weight=int(key[2:]), genome=g['id'])
+            assemblies.append(assembly)
+
+    def serialise(data):
+        body = json.dumps(data, sort_keys=True)
+        return body, hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+    by_genome = dict((g['id'], serialise(dict(assemblies=[
+        a for a in assemblies if a['genome'] == g['id']]))) for g in genomes)
+    return dict(
+        assembly_ids=tuple(a['id'] for a in assemblies),
+        genomes_json=json.dumps(genomes),
+        assemblies_json=json.dumps(assemblies),
+        api_genomes=serialise(dict(genomes=genomes)),
+        api_assemblies=by_genome,
+        api_no_assemblies=serialise(dict(assemblies=[])))
+
+
+def _load_catalogue(*args):
+    """(Re)build the catalogue, also the SIGHUP handler"""
+    global catalogue
+    Genome.init(app.config['DATA_PATH'])
+    catalogue = _build_catalogue()
+    gene_search.clear()
+
+
+catalogue = _build_catalogue()
+# assembly -> (build stamp of its gene index, GeneIndex)
+gene_search = {}
+try:
+    signal.signal(signal.SIGHUP, _load_catalogue)
+except ValueError:
+    # not in the main thread, the server has to take care of reloading
+    pass
+
+
+def _cached_json(serialised):
+    """Response for pre-serialised JSON, cacheable by clients"""
+    body, etag = serialised
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['CATALOGUE_MAX_AGE']
+    return response.make_conditional(request)
 
 
 def _dict_to_bed(data):
@@ -92,9 +153,7 @@ def _dict_to_bed(data):
 
 @app.context_processor
 def inject_data():
-    assemblies = [x['assemblies'] for x in Genome.all().values()]
-    assemblies = (xx for x in assemblies for xx in x)
-    return dict(_assemblies=assemblies)
+    return dict(_assemblies=catalogue['assembly_ids'])
 
 
 @app.route('/')
@@ -134,25 +193,129 @@ def index():
     else:
         uuid = _create_session()
 
-    genomes = json.dumps(_list_genomes())
-    assemblies = json.dumps(_list_assemblies())
-    return render_template('index.html', genomes=genomes,
-                           assemblies=assemblies, uuid=uuid,
-                           custom_regulator=custom_regulator)
+    status_streams = 'true' if app.config['STATUS_STREAMS'] else 'false'
+    return render_template('index.html', genomes=catalogue['genomes_json'],
+                           assemblies=catalogue['assemblies_json'], uuid=uuid,
+                           custom_regulator=custom_regulator,
+                           status_streams=status_streams)
 
 
-@app.route('/api/v1.0/status/<uuid>')
-def status(uuid):
-    # uuid here shadows global uuid var,
-    # but it seems a feature, not a bug
+def _session_status(uuid):
     key = "sessions:{0}".format(uuid)
     if conn.exists(key):
         _status = json.loads(conn.get(key))
         _status['ttl'] = conn.ttl(key)
     else:
         _status = dict(uuid=uuid, state='expired')
+    return _status
+
+
+@app.route('/api/v1.0/status/<uuid>')
+def status(uuid):
+    # uuid here shadows global uuid var,
+    # but it seems a feature, not a bug
+    return jsonify(_session_status(uuid))
+
+
+def _status_events(uuid):
+    """Server-sent events for the state changes of a session
+
+    Workers publish every new state on the channel named like the
+    session key. The stream ends with the first final state or after
+    STATUS_STREAM_TIMEOUT seconds, EventSource clients then reconnect.
+    """
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the state, so no change is lost in between
+    pubsub.subscribe("sessions:{0}".format(uuid))
+    try:
+        _status = _session_status(uuid)
+        yield 'data: {0}\n\n'.format(json.dumps(_status))
+        deadline = time.time() + app.config['STATUS_STREAM_TIMEOUT']
+        while _status['state'] in ('pending', 'running') and \
+                time.time() < deadline:
+            message = pubsub.get_message(
+                timeout=app.config['STATUS_HEARTBEAT'])
+            if message is None:
+                # keeps proxies from closing an idle connection
+                yield ': heartbeat\n\n'
+                continue
+            _status = json.loads(message['data'])
+            yield 'data: {0}\n\n'.format(message['data'])
+    finally:
+        pubsub.close()
+
+
+@app.route('/api/v1.0/status/<uuid>/stream')
+def status_stream(uuid):
+    return Response(stream_with_context(_status_events(uuid)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def _session_done(unique_id, query_key):
+    """Point a session at the cached result under query_key"""
+    session = "sessions:{}".format(unique_id)
+    session_dict = dict(uuid=unique_id, state='done')
+    _touch_result(query_key)
+    conn.set(session, json.dumps(session_dict))
+    conn.expire(session, app.config['SESSION_TTL'])
+    conn.set("results:{0}".format(session),
+             json.dumps(dict(redirect=query_key)))
+    conn.expire("results:{0}".format(session), app.config['SESSION_TTL'])
+    return jsonify(session_dict)
 
-    return jsonify(_status)
+
+def _join_job(query_key, query_pending_key, unique_id):
+    """Attach a session to the job computing query_key
+
+    Returns 'enqueue' when the session now holds the pending marker and
+    has to enqueue the job, 'pending' when an identical job is already
+    pending and 'done' when its result appeared in the meantime.
+
+    Claiming the marker and joining its waiters happen in one
+    transaction, and workers drain the waiters and drop the marker in
+    one transaction after writing the result, so every session is
+    either notified by the worker or sees the result here. The marker
+    outlives a job queued and running for JOB_TIMEOUT seconds each.
+    """
+    waiters = waiters_key(query_pending_key)
+    pending_ttl = 2 * app.config['JOB_TIMEOUT']
+    pipe = conn.pipeline()
+    pipe.sadd(waiters, unique_id)
+    pipe.expire(waiters, pending_ttl)
+    pipe.set(query_pending_key, unique_id, nx=True, ex=pending_ttl)
+    pipe.hmget(query_key, 'rows', 'running')
+    _, _, claimed, (rows, running) = pipe.execute()
+    if rows is not None and running is None:
+        if claimed:
+            conn.delete(query_pending_key, waiters)
+        return 'done'
+    return 'enqueue' if claimed else 'pending'
+
+
+def _job_cost(query):
+    """Rough cost of an analysis, in single regulator gene set runs"""
+    cost = len(query['set_a']) + len(query['set_b'] or [])
+    if query['genes'] == [u'all']:
+        cost *= 2
+    # windows widen the intervals to intersect
+    cost += sum(1 for window in ('window_a', 'window_b') if window in query)
+    return cost
+
+
+def _job_queue(func, query):
+    """Name of the rq queue a job for query should wait in
+
+    Gene filters and combinations of cached results are cheap and go to
+    FAST_QUEUE, analyses to STANDARD_QUEUE or, from HEAVY_JOB_COST on,
+    to HEAVY_QUEUE.
+    """
+    if func is not run_analyse:
+        return app.config['FAST_QUEUE']
+    if _job_cost(query) >= app.config['HEAVY_JOB_COST']:
+        return app.config['HEAVY_QUEUE']
+    return app.config['STANDARD_QUEUE']
 
 
 @app.route('/api/v1.0/search', methods=['POST'])
@@ -185,7 +348,7 @@ def search():
     if window_b > -1:
         query['window_b'] = window_b
 
-    query_key = "results:%s" % json.dumps(query, sort_keys=True)
+    query_key = result_key(query)
     query_pending_key = "%s_pending" % query_key
     unique_id = request.form.get('uuid', u'invalid')
     session = "sessions:{}".format(unique_id)
@@ -193,56 +356,63 @@ def search():
         unique_id = _create_session()
         session = "sessions:{}".format(unique_id)
 
-    if conn.exists(query_key):
-        session_dict = dict(uuid=unique_id, state='done')
-        conn.expire(query_key, app.config['RESULT_TTL'])
-        conn.set(session, json.dumps(session_dict))
-        conn.expire(session, app.config['SESSION_TTL'])
-        conn.set("results:{0}".format(session),
-                 json.dumps(dict(redirect=query_key)))
-        conn.expire("results:{0}".format(session),
-                    app.config['SESSION_TTL'])
-        return jsonify(session_dict)
-
-    elif query['genes'][0] != u'all':
+    if store.complete(query_key):
+        return _session_done(unique_id, query_key)
+
+    if query['genes'][0] != u'all':
         full_query = dict(query)
         full_query['genes'] = [u'all']
-        full_query_key = "results:%s" % json.dumps(full_query, sort_keys=True)
-
-        if conn.exists(full_query_key):
-            conn.expire(full_query_key, app.config['RESULT_TTL'])
-            conn.set(query_pending_key, True)
-            conn.expire(query_pending_key, 30)
-            session_dict = dict(state='pending', uuid=unique_id)
-            conn.set('sessions:{0}'.format(unique_id),
-                     json.dumps(session_dict))
-            conn.expire(
-                'sessions:{0}'.format(unique_id), app.config['SESSION_TTL'])
-            q = Queue(connection=conn, default_timeout=600)
-
-            q.enqueue(filter_genes, query['genes'], full_query_key, query_key,
-                      query_pending_key, unique_id,
-                      session_ttl=app.config['SESSION_TTL'],
-                      result_ttl=app.config['RESULT_TTL'])
-            return jsonify(session_dict)
+        full_query_key = result_key(full_query)
+    else:
+        full_query_key = None
+    if query['set_b'] is not None:
+        key_a, key_b = map(result_key, sub_queries(query))
+    else:
+        key_a = key_b = None
+
+    if full_query_key is not None and store.complete(full_query_key):
+        _touch_result(full_query_key)
+        job = (filter_genes, query['genes'], full_query_key, query_key,
+               query_pending_key, unique_id)
+        job_kwargs = dict(session_ttl=app.config['SESSION_TTL'],
+                          result_ttl=app.config['RESULT_TTL'],
+                          result_backend=app.config['RESULT_BACKEND'],
+                          result_path=app.config['RESULT_PATH'])
+    elif key_a is not None and _usable_result(key_a) and \
+            _usable_result(key_b):
+        # combine cached set A and set B results instead of a new analysis
+        _touch_result(key_a)
+        _touch_result(key_b)
+        job = (combine_results, query['combine'], key_a, key_b, query_key,
+               query_pending_key, unique_id)
+        job_kwargs = dict(session_ttl=app.config['SESSION_TTL'],
+                          result_ttl=app.config['RESULT_TTL'],
+                          result_backend=app.config['RESULT_BACKEND'],
+                          result_path=app.config['RESULT_PATH'],
+                          genome_wide=query['genes'] == [u'all'])
+    else:
+        job = (run_analyse, app.config['DATA_PATH'], query_key,
+               query_pending_key, query, unique_id)
+        job_kwargs = dict(SESSION_STORE=app.config['SESSION_STORE'],
+                          RESULT_TTL=app.config['RESULT_TTL'],
+                          SESSION_TTL=app.config['SESSION_TTL'],
+                          RESULT_BACKEND=app.config['RESULT_BACKEND'],
+                          RESULT_PATH=app.config['RESULT_PATH'],
+                          PROCESSES=app.config['ANALYSE_PROCESSES'])
 
     session_dict = dict(state='pending', uuid=unique_id)
     conn.set('sessions:{0}'.format(unique_id), json.dumps(session_dict))
     conn.expire('sessions:{0}'.format(unique_id),
                 app.config['SESSION_TTL'])
 
-    if conn.get(query_pending_key):
-        return jsonify(session_dict)
-
-    conn.set(query_pending_key, True)
-    conn.expire(query_pending_key, 30)
-
-    q = Queue(connection=conn, default_timeout=600)
-    q.enqueue(run_analyse, app.config['DATA_PATH'], query_key,
-              query_pending_key, query, unique_id,
-              SESSION_STORE=app.config['SESSION_STORE'],
-              RESULT_TTL=app.config['RESULT_TTL'],
-              SESSION_TTL=app.config['SESSION_TTL'])
+    joined = _join_job(query_key, query_pending_key, unique_id)
+    if joined == 'done':
+        return _session_done(unique_id, query_key)
+    if joined == 'enqueue':
+        q = Queue(_job_queue(job[0], query), connection=raw_conn,
+                  default_timeout=app.config['JOB_TIMEOUT'])
+        # explicit args and kwargs, enqueue would take result_ttl for itself
+        q.enqueue(job[0], args=job[1:], kwargs=job_kwargs)
 
     return jsonify(session_dict)
 
@@ -258,18 +428,43 @@ def download_regulator(assembly, name):
     return send_file(regulator.path, as_attachment=True)
 
 
+def _stream_result(query_key, compress=False):
+    """Yield a stored result in batches, optionally gzip compressed"""
+    batch_size = app.config['DOWNLOAD_BATCH_SIZE']
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) \
+        if compress else None
+
+    for rows in store.iter_rows(query_key, batch_size):
+        chunk = ''.join(row + '\n' for row in rows).encode('utf-8')
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
 @app.route('/api/v1.0/download/results/<uuid>')
 def download_results(uuid):
     key = "results:sessions:{0}".format(uuid)
     if not conn.exists(key):
         flask.abort(404)
 
-    result_key = json.loads(conn.get(key))['redirect']
-    result = '\n'.join(conn.lrange(result_key, 0, -1))
-    return send_file(BytesIO(result.encode('utf-8')),
-                     mimetype='text/tsv',
-                     attachment_filename='carina_{}.txt'.format(uuid),
-                     as_attachment=True)
+    query_key = json.loads(conn.get(key))['redirect']
+    compress = request.args.get('compress') == 'gzip'
+    filename = 'carina_{}.txt'.format(uuid)
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/tsv'
+
+    return Response(
+        stream_with_context(_stream_result(query_key, compress)),
+        mimetype=mimetype,
+        headers={'Content-Disposition':
+                 'attachment; filename={}'.format(filename)})
 
 
 @app.route('/news')
@@ -308,13 +503,13 @@ def docs_api(page):
 
 @app.route('/api/v1.0/genomes')
 def api_list_genomes():
-    return jsonify(dict(genomes=_list_genomes()))
+    return _cached_json(catalogue['api_genomes'])
 
 
 @app.route('/api/v1.0/assemblies/<genome>')
 def api_list_assemblies(genome):
-    assemblies = [x for x in _list_assemblies() if x['genome'] == genome]
-    return jsonify(dict(assemblies=assemblies))
+    return _cached_json(catalogue['api_assemblies'].get(
+        genome, catalogue['api_no_assemblies']))
 
 
 @app.route('/api/v1.0/regulators/<assembly>')
@@ -337,66 +532,178 @@ def list_regulators(assembly):
     return jsonify(regulators_)
 
 
+def build_gene_index(assembly):
+    """Load the genes of an assembly into a sorted set
+
+    Only one process builds a given index at a time, the genes are added
+    in pipelined batches to a temporary key that replaces the index in
+    one step. Returns False if another build holds the lock.
+    """
+    cache_key = "genes:{0}".format(assembly)
+    lock_key = "{0}_lock".format(cache_key)
+    if not conn.set(lock_key, os.getpid(), nx=True,
+                    ex=app.config['GENES_LOCK_TIMEOUT']):
+        return False
+
+    try:
+        tmp_key = "{0}_building".format(cache_key)
+        conn.delete(tmp_key)
+        genes = list(Genome.get_genes(assembly))
+        batch_size = app.config['GENES_BATCH_SIZE']
+        pipe = conn.pipeline(transaction=False)
+        for i in range(0, len(genes), batch_size):
+            pipe.zadd(tmp_key, dict.fromkeys(genes[i:i + batch_size], 0))
+        pipe.execute()
+        if genes:
+            built_key = "{0}_built".format(cache_key)
+            pipe = conn.pipeline()
+            pipe.rename(tmp_key, cache_key)
+            # tells the search indexes of all processes to reload
+            pipe.set(built_key, '{0}:{1!r}'.format(os.getpid(), time.time()))
+            if app.config['GENES_TTL']:
+                pipe.expire(cache_key, app.config['GENES_TTL'])
+                pipe.expire(built_key, app.config['GENES_TTL'])
+            pipe.execute()
+    finally:
+        conn.delete(lock_key)
+    return True
+
+
+def _gene_index(assembly):
+    """Key of the gene index of an assembly, built if missing"""
+    cache_key = "genes:{0}".format(assembly)
+    if conn.exists(cache_key) or build_gene_index(assembly):
+        return cache_key
+
+    # another request is building the index, wait for it
+    deadline = time.time() + app.config['GENES_LOCK_TIMEOUT']
+    while time.time() < deadline and not conn.exists(cache_key) \
+            and conn.exists("{0}_lock".format(cache_key)):
+        time.sleep(0.1)
+    return cache_key
+
+
+def _gene_search(assembly):
+    """In-process search index of an assembly, loaded from its gene index
+
+    Aliases are read from an optional {assembly}_gene_aliases.json file
+    in DATA_PATH mapping gene names to lists of aliases. The index is
+    reloaded once build_gene_index() rebuilt the gene index, in any
+    process.
+    """
+    built_key = "genes:{0}_built".format(assembly)
+    cached = gene_search.get(assembly)
+    if cached is not None and cached[0] == conn.get(built_key):
+        return cached[1]
+
+    cache_key = _gene_index(assembly)
+    # read before the genes, a build in between is picked up next time
+    built = conn.get(built_key)
+    genes = conn.zrange(cache_key, 0, -1)
+    aliases_path = os.path.join(
+        app.config['DATA_PATH'], '{}_gene_aliases.json'.format(assembly))
+    aliases = None
+    if os.path.exists(aliases_path):
+        with open(aliases_path) as open_f:
+            aliases = json.load(open_f)
+    index = GeneIndex(genes, aliases)
+    if genes:
+        gene_search[assembly] = (built, index)
+    return index
+
+
+def warm_gene_indexes(report=app.logger.info):
+    """Build the gene index of every assembly"""
+    for assembly in catalogue['assembly_ids']:
+        if build_gene_index(assembly):
+            _gene_search(assembly)
+            report('indexed genes of {0}'.format(assembly))
+        else:
+            report('index of {0} is being built elsewhere'.format(assembly))
+
+
+@app.cli.command('warm-genes')
+def warm_genes():
+    """Build the gene index of every assembly"""
+    warm_gene_indexes(print)
+
+
 @app.route('/api/v1.0/genes/<assembly>', defaults={'query': ''})
 @app.route('/api/v1.0/genes/<assembly>/<query>')
 def list_genes(assembly, query):
-    if query != '':
-        start = "[{0}".format(query)
-        end = "(" + start[1:-1] + chr(ord(start[-1]) + 1)
-    else:
-        start = "-"
-        end = "+"
+    limit = request.args.get('limit', app.config['GENES_LIMIT'], int)
+    limit = min(max(limit, 1), app.config['GENES_LIMIT'])
+    return jsonify(dict(genes=_gene_search(assembly).search(query, limit)))
 
-    cache_key = "genes:{0}".format(assembly)
 
-    if not conn.exists(cache_key):
-        new_genes = Genome.get_genes(assembly)
-        for gene in new_genes:
-            conn.zadd(cache_key, gene, 0)
+def _page_bounds(offset, limit):
+    """Clamp a requested result page to the configured page size"""
+    return max(offset, 0), min(max(limit, 1), app.config['MAX_PAGE_SIZE'])
+
+
+def _result_page(result, offset, limit, total_results, running=False):
+    """The get_result response for a page of a stored result
+
+    While the analysis is running, total_results counts the rows stored
+    so far, the state is 'running' and more results are to come.
+    """
+    if result and 'Job failed' in result[0]:
+        return dict(state='error', results=[], message=result[0],
+                    total_results=0)
 
-    genes = conn.zrangebylex(cache_key, start, end)
-    return jsonify(dict(genes=genes[:500]))
+    next_offset = offset + limit
+    truncated = next_offset < total_results
+    response = dict(state='running' if running else 'done', results=result,
+                    more_results=running or truncated,
+                    next_offset=next_offset, total_results=total_results)
+    if truncated and not running:
+        response['message'] = 'The result table was limited due to its ' \
+                              'size, please limit your search query or use ' \
+                              'the download button.'
+    return response
 
 
-@app.route('/api/v1.0/result/<uuid>')
-def get_result(uuid):
+@app.route('/api/v1.0/result/<uuid>', defaults={'offset': None})
+@app.route('/api/v1.0/result/<uuid>/<int:offset>')
+def get_result(uuid, offset):
     key = "results:sessions:{0}".format(uuid)
     if not conn.exists(key):
         return jsonify(dict(uuid=uuid, state='expired'))
 
+    if offset is None:
+        offset = request.args.get('offset', 0, int)
+    offset, limit = _page_bounds(
+        offset, request.args.get('limit', app.config['MAX_RESULTS'], int))
+
     rec = json.loads(conn.get(key))
     query_key = str(rec['redirect'])
-    conn.expire(query_key, app.config['RESULT_TTL'])
-    result = conn.lrange(query_key, 0, -1)
-    if len(result) > 1000:
-        return jsonify(
-            dict(state='done', results=result[:999],
-                 message='The result table was limited due to its size, '
-                         'please limit your search query or use the download '
-                         'button.',
-                 total_results=len(result)))
-
-    if 'Job failed' in result[0]:
-        app.logger.error(result[0])
-        return jsonify(
-            dict(state='error', results=[], message=result[0], total_results=0))
+    _touch_result(query_key)
+    # only decompress the blocks of the requested page
+    result = store.read(query_key, offset, offset + limit)
+    total_results = store.count(query_key)
+    running = store.running(query_key)
 
-    return jsonify(
-        dict(state='done', results=result, total_results=len(result)))
+    if result and 'Job failed' in result[0]:
+        app.logger.error(result[0])
+    return jsonify(_result_page(result, offset, limit, total_results,
+                                running))
 
 
 @app.route('/api/v1.0/tissues/<assembly>/')
 @app.route('/api/v1.0/tissues/<assembly>/<tissue>')
 def get_tissues(assembly, tissue=None):
-    path = app.config["DATA_PATH"] + '/{}_tissues.json'.format(assembly)
-    with open(path) as open_f:
-        genes_p_tissue = json.load(open_f)
     if tissue is None:
-        return jsonify(dict(tissue=list(genes_p_tissue.keys())))
-    try:
-        return jsonify(dict(genes=genes_p_tissue[tissue]))
-    except KeyError:
+        return jsonify(dict(
+            tissue=tissues.names(app.config["DATA_PATH"], assembly)))
+    genes = tissues.genes(app.config["DATA_PATH"], assembly, tissue)
+    if genes is None:
         return jsonify(dict(message='Tissue not found'))
+    return jsonify(dict(genes=genes))
+
+
+if app.config['WARM_GENES']:
+    threading.Thread(target=warm_gene_indexes, name='warm-genes',
+                     daemon=True).start()
 
 
 if __name__ == "__main__":
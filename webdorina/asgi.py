@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ASGI entry point of webdorina.
+
+The endpoints clients hold open or poll while a search runs, session
+status, status streams, result pages and result downloads, are served
+by coroutines on an asyncio Redis client, so one process keeps many of
+them open without a thread each. All other routes are handed to the
+Flask app of webdorina.app.
+
+    uvicorn webdorina.asgi:application
+
+webdorina/wsgi.py stays the entry point for WSGI servers.
+"""
+import asyncio
+import json
+import time
+import zlib
+
+from asgiref.wsgi import WsgiToAsgi
+from redis import asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from webdorina.app import app, _page_bounds, _result_page
+from webdorina.results import block_numbers, gene_index_key, \
+    read_file_blocks, slice_blocks
+
+# status streams are cheap here, let the search page use them
+app.config['STATUS_STREAMS'] = True
+
+conn = aioredis.Redis(decode_responses=True)
+# result blocks are binary
+blocks_conn = aioredis.Redis()
+
+
+async def _session_status(uuid):
+    key = "sessions:{0}".format(uuid)
+    async with conn.pipeline(transaction=False) as pipe:
+        value, ttl = await pipe.get(key).ttl(key).execute()
+    if value is None:
+        return dict(uuid=uuid, state='expired')
+    _status = json.loads(value)
+    _status['ttl'] = ttl
+    return _status
+
+
+async def _redirect(uuid):
+    """Key of the result of a session, None once the session expired"""
+    value = await conn.get("results:sessions:{0}".format(uuid))
+    if value is None:
+        return None
+    return str(json.loads(value)['redirect'])
+
+
+async def _header(query_key):
+    """Rows, block size and whether the result is still running"""
+    rows, block_size, running = await blocks_conn.hmget(
+        query_key, 'rows', 'block_size', 'running')
+    if rows is None:
+        return 0, 1, False
+    return int(rows), int(block_size), running is not None
+
+
+async def _load(query_key, numbers):
+    """Compressed blocks of a result, see webdorina.results"""
+    values = await blocks_conn.hmget(query_key, ['path'] + list(numbers))
+    if values[0] is None:
+        return values[1:]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, read_file_blocks, values[0],
+                                      numbers)
+
+
+async def _read(query_key, start, stop):
+    """Rows[start:stop], the number of rows and the running flag"""
+    rows, block_size, running = await _header(query_key)
+    numbers = block_numbers(rows, block_size, start, stop)
+    if not numbers:
+        return [], rows, running
+    blocks = await _load(query_key, numbers)
+    return (slice_blocks(blocks, numbers[0], block_size, start, stop), rows,
+            running)
+
+
+async def status(request):
+    return JSONResponse(await _session_status(request.path_params['uuid']))
+
+
+async def _status_events(uuid):
+    """Server-sent events for the state changes of a session
+
+    Same stream as webdorina.app.status_stream.
+    """
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe("sessions:{0}".format(uuid))
+    try:
+        _status = await _session_status(uuid)
+        yield 'data: {0}\n\n'.format(json.dumps(_status))
+        deadline = time.time() + app.config['STATUS_STREAM_TIMEOUT']
+        while _status['state'] in ('pending', 'running') and \
+                time.time() < deadline:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=app.config['STATUS_HEARTBEAT'])
+            if message is None:
+                yield ': heartbeat\n\n'
+                continue
+            _status = json.loads(message['data'])
+            yield 'data: {0}\n\n'.format(message['data'])
+    finally:
+        await pubsub.reset()
+
+
+async def status_stream(request):
+    return StreamingResponse(_status_events(request.path_params['uuid']),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache',
+                                      'X-Accel-Buffering': 'no'})
+
+
+async def get_result(request):
+    uuid = request.path_params['uuid']
+    query_key = await _redirect(uuid)
+    if query_key is None:
+        return JSONResponse(dict(uuid=uuid, state='expired'))
+
+    try:
+        offset = int(request.path_params.get(
+            'offset', request.query_params.get('offset', 0)))
+    except ValueError:
+        offset = 0
+    try:
+        limit = int(request.query_params.get('limit',
+                                             app.config['MAX_RESULTS']))
+    except ValueError:
+        limit = app.config['MAX_RESULTS']
+    offset, limit = _page_bounds(offset, limit)
+
+    async with conn.pipeline(transaction=False) as pipe:
+        await pipe.expire(query_key, app.config['RESULT_TTL']).expire(
+            gene_index_key(query_key), app.config['RESULT_TTL']).execute()
+    result, total_results, running = await _read(query_key, offset,
+                                                 offset + limit)
+    if result and 'Job failed' in result[0]:
+        app.logger.error(result[0])
+    return JSONResponse(_result_page(result, offset, limit, total_results,
+                                     running))
+
+
+async def _stream_result(query_key, compress):
+    """Yield a stored result in batches, optionally gzip compressed"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) \
+        if compress else None
+    rows, block_size, _ = await _header(query_key)
+    num_blocks = -(-rows // block_size)
+    step = max(app.config['DOWNLOAD_BATCH_SIZE'] // block_size, 1)
+
+    for first in range(0, num_blocks, step):
+        numbers = list(range(first, min(first + step, num_blocks)))
+        blocks = [block for block in await _load(query_key, numbers)
+                  if block is not None]
+        if not blocks:
+            continue
+        lines = slice_blocks(blocks, 0, block_size, 0, None)
+        chunk = ''.join(line + '\n' for line in lines).encode('utf-8')
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+async def download_results(request):
+    uuid = request.path_params['uuid']
+    query_key = await _redirect(uuid)
+    if query_key is None:
+        return Response(status_code=404)
+
+    compress = request.query_params.get('compress') == 'gzip'
+    filename = 'carina_{}.txt'.format(uuid)
+    if compress:
+        filename += '.gz'
+        media_type = 'application/gzip'
+    else:
+        media_type = 'text/tsv'
+
+    return StreamingResponse(
+        _stream_result(query_key, compress), media_type=media_type,
+        headers={'Content-Disposition':
+                 'attachment; filename={}'.format(filename)})
+
+
+routes = [
+    Route('/api/v1.0/status/{uuid}', status),
+    Route('/api/v1.0/status/{uuid}/stream', status_stream),
+    Route('/api/v1.0/result/{uuid}', get_result),
+    Route('/api/v1.0/result/{uuid}/{offset:int}', get_result),
+    Route('/api/v1.0/download/results/{uuid}', download_results),
+    Mount('/', app=WsgiToAsgi(app)),
+]
+
+application = Starlette(routes=routes)
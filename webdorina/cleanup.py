@@ -1,34 +1,274 @@
 #!/usr/bin/env python
 # coding=utf-8
+"""
+Remove the session directories and result files of expired sessions and
+results.
+
+    python -m webdorina.cleanup [CONFIG]
+
+Paths are taken from webdorina/config.py and the optional user config,
+as for webdorina.app. Keyspace expiry events are handed to a thread pool,
+so slow deletions don't hold up the subscription. Events are lost while
+the daemon is down, so it also sweeps on start and every
+CLEANUP_SWEEP_INTERVAL seconds: session directories without a live
+`sessions:` key and, with the disk RESULT_BACKEND, result files without
+a header are removed. Either way, files changed within the last
+CLEANUP_MIN_AGE seconds are kept, they may belong to a key being
+written again.
+
+Counters of the removals are kept in the `cleanup:metrics` hash:
+directories and files removed, bytes freed, orphans found by sweeps,
+errors, deletions still queued and the lag between an expiry event and
+its deletion, in seconds.
+"""
 
 from __future__ import print_function
 from __future__ import unicode_literals
+import argparse
+import glob
+import logging
+import os
 import shutil
-import daemon
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+
+import daemon
+from flask import Config
 from redis import StrictRedis
 
+from webdorina.results import FileResultStore
+
+logger = logging.getLogger('webdorina.cleanup')
+this_dir = path.dirname(path.abspath(__file__))
+
+METRICS_KEY = 'cleanup:metrics'
+
+
+def load_config(filename=None):
+    """The app defaults, updated from the user config filename"""
+    config = Config(this_dir)
+    config.from_pyfile('config.py')
+    if filename is not None:
+        config.from_pyfile(path.abspath(filename))
+    return config
+
+
+def _session_id(value):
+    """value if it is a session id, None otherwise"""
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return None
+    return value
+
+
+def session_dirs(session_store):
+    """Yield the session id and directory of all SESSION_STORE dirs"""
+    prefix, _, suffix = session_store.partition('{unique_id}')
+    pattern = glob.escape(prefix) + '*' + glob.escape(suffix)
+    for dirname in glob.glob(pattern):
+        unique_id = _session_id(dirname[len(prefix):
+                                        len(dirname) - len(suffix)])
+        if unique_id is not None and path.isdir(dirname):
+            yield unique_id, dirname
+
+
+def disk_usage(dirname):
+    """Bytes of the files below dirname"""
+    total = 0
+    for root, _, files in os.walk(dirname):
+        for name in files:
+            try:
+                total += os.lstat(path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+class Metrics(object):
+    """Thread-safe counters of the cleanup"""
 
-def callback(message):
-    if message['data'].startswith('sessions:'):
-        uuid = message['data'].split(':')[-1]
-        session_dir = path.join('/tmp', "dorina-{}".format(uuid))
-        print("deleting {session_dir}".format(session_dir=session_dir))
-        if path.exists(session_dir):
-            shutil.rmtree(session_dir, ignore_errors=True)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = dict(dirs_removed=0, files_removed=0, bytes_freed=0,
+                           swept=0, errors=0, queued=0, lag=0.0, max_lag=0.0)
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.values[name] += count
+
+    def lag(self, seconds):
+        with self._lock:
+            self.values['lag'] = seconds
+            self.values['max_lag'] = max(self.values['max_lag'], seconds)
+
+    def publish(self, redis_store):
+        with self._lock:
+            values = dict(self.values)
+        redis_store.hset(METRICS_KEY, mapping=values)
+        return values
+
+
+class Cleanup(object):
+    """Delete the files of expired keys, see the module docstring"""
+
+    def __init__(self, redis_store, config):
+        self.redis_store = redis_store
+        self.session_store = config['SESSION_STORE']
+        self.min_age = config['CLEANUP_MIN_AGE']
+        if config['RESULT_BACKEND'] == 'disk':
+            # result headers hold binary blocks
+            self.results = FileResultStore(StrictRedis(),
+                                           config['RESULT_PATH'])
+        else:
+            self.results = None
+        self.pool = ThreadPoolExecutor(config['CLEANUP_THREADS'])
+        self.metrics = Metrics()
+
+    def remove_dir(self, dirname):
+        """Remove a session directory, returns whether it existed"""
+        if not path.isdir(dirname):
+            return False
+        size = disk_usage(dirname)
+        logger.info("deleting {}".format(dirname))
+        try:
+            shutil.rmtree(dirname)
+        except FileNotFoundError:
+            # removed by an expiry event and a sweep at once
+            return False
+        self.metrics.add(dirs_removed=1, bytes_freed=size)
+        return True
+
+    def remove_file(self, filename):
+        """Remove a result file, returns whether it existed"""
+        try:
+            size = os.stat(filename).st_size
+            os.remove(filename)
+        except FileNotFoundError:
+            return False
+        logger.info("deleting {}".format(filename))
+        self.metrics.add(files_removed=1, bytes_freed=size)
+        return True
+
+    def expired(self, message):
+        """pub/sub handler of expiry events, queues the deletion"""
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        if not key.startswith('sessions:') and not (
+                key.startswith('results:') and self.results is not None):
+            return
+        self.metrics.add(queued=1)
+        self.pool.submit(self._expired, key, time.time())
+
+    def _fresh(self, filename):
+        """Whether filename changed within the last CLEANUP_MIN_AGE seconds"""
+        try:
+            return path.getmtime(filename) > time.time() - self.min_age
+        except FileNotFoundError:
+            return False
+
+    def _expired(self, key, received):
+        try:
+            if key.startswith('sessions:'):
+                unique_id = _session_id(key[len('sessions:'):])
+                filenames = [] if unique_id is None else \
+                    [self.session_store.format(unique_id=unique_id)]
+                remove = self.remove_dir
+            else:
+                # results of the disk backend, see FileResultStore
+                filenames = self.results.files_for(key)
+                remove = self.remove_file
+            # the key may have been written again since it expired, and
+            # result files are written before their header is set
+            if not self.redis_store.exists(key):
+                for filename in filenames:
+                    if not self._fresh(filename):
+                        remove(filename)
+        except OSError:
+            logger.exception('Failed to clean up {}'.format(key))
+            self.metrics.add(errors=1)
+        finally:
+            self.metrics.add(queued=-1)
+            self.metrics.lag(time.time() - received)
+            self.metrics.publish(self.redis_store)
+
+    def sweep(self):
+        """Remove the files of keys whose expiry events were missed
+
+        Files younger than CLEANUP_MIN_AGE seconds are kept. Returns the
+        number of removed directories and files.
+        """
+        swept = 0
+        cutoff = time.time() - self.min_age
+        candidates = list(session_dirs(self.session_store))
+        with self.redis_store.pipeline(transaction=False) as pipe:
+            for unique_id, _ in candidates:
+                pipe.exists("sessions:{0}".format(unique_id))
+            live = pipe.execute()
+        for (_, dirname), alive in zip(candidates, live):
+            if alive:
+                continue
+            try:
+                if path.getmtime(dirname) > cutoff:
+                    continue
+                if self.remove_dir(dirname):
+                    swept += 1
+            except OSError:
+                logger.exception('Failed to remove {}'.format(dirname))
+                self.metrics.add(errors=1)
+
+        if self.results is not None:
+            for _, size in self.results.purge(self.min_age):
+                self.metrics.add(files_removed=1, bytes_freed=size)
+                swept += 1
+
+        self.metrics.add(swept=swept)
+        logger.info('sweep removed {}, {}'.format(
+            swept, self.metrics.publish(self.redis_store)))
+        return swept
+
+    def serve(self, pubsub, interval):
+        """Handle expiry events and sweep every interval seconds"""
+        sweep = self.pool.submit(self.sweep)
+        next_sweep = time.time() + interval
+        while True:
+            # the handler is called by get_message
+            pubsub.get_message(timeout=1.0)
+            if time.time() >= next_sweep and sweep.done():
+                sweep = self.pool.submit(self.sweep)
+                next_sweep = time.time() + interval
 
 
 def main():
-    r = StrictRedis()
-    r.config_set('notify-keyspace-events', 'Ex')
-    p = r.pubsub(ignore_subscribe_messages=True)
-    p.psubscribe(**{'__keyevent@0__:expired': callback})
-    # pop the subscribe message
-    p.get_message()
-    for message in p.listen():
-        pass
+    parser = argparse.ArgumentParser(
+        description='Remove the files of expired sessions and results')
+    parser.add_argument('config', nargs='?',
+                        help='user config, as passed to webdorina.app')
+    parser.add_argument('--foreground', action='store_true',
+                        help="don't daemonize")
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    def run():
+        logging.basicConfig(level=logging.INFO)
+        r = StrictRedis(decode_responses=True)
+        r.config_set('notify-keyspace-events', 'Ex')
+        cleanup = Cleanup(r, config)
+        p = r.pubsub(ignore_subscribe_messages=True)
+        p.psubscribe(**{'__keyevent@0__:expired': cleanup.expired})
+        cleanup.serve(p, config['CLEANUP_SWEEP_INTERVAL'])
+
+    if args.foreground:
+        run()
+    else:
+        with daemon.DaemonContext():
+            run()
 
 
 if __name__ == "__main__":
-    with daemon.DaemonContext():
-        main()
+    main()
@@ -10,7 +10,47 @@ data_path=os.path.join(os.path.dirname(__file__), 'test', 'data')
 SESSION_TTL=3600
 RESULT_TTL=86400
 REGULATORS_TTL=3600
+# gene autocomplete index, GENES_TTL=None keeps it until the next build
+GENES_TTL=None
+GENES_BATCH_SIZE=5000
+GENES_LOCK_TIMEOUT=60
+# most genes returned by the autocomplete
+GENES_LIMIT=500
+# build all gene indexes in the background when the app starts
+WARM_GENES=False
+# seconds clients may cache the genome and assembly lists
+CATALOGUE_MAX_AGE=3600
+# server-sent status events, seconds per stream and between heartbeats
+STATUS_STREAM_TIMEOUT=300
+STATUS_HEARTBEAT=15
+# the search page follows jobs over status streams instead of polling;
+# under WSGI each open stream holds a worker, webdorina.asgi turns it on
+STATUS_STREAMS=False
+# seconds a job may run, identical searches join it until it ends
+JOB_TIMEOUT=600
+# rq queues by job size, see the README for the workers to run
+FAST_QUEUE='fast'
+STANDARD_QUEUE='default'
+HEAVY_QUEUE='heavy'
+# analyses from this cost on go to HEAVY_QUEUE, one regulator counts 1,
+# twice over all genes, and each window adds 1
+HEAVY_JOB_COST=4
+# processes analysing the regulators of a query, and the chromosomes of a
+# genome-wide query, in parallel; every rq work horse forks this many, so
+# keep workers * ANALYSE_PROCESSES within the cores. None uses all cores,
+# 1 analyses in the work horse itself
+ANALYSE_PROCESSES=1
 MAX_RESULTS=100
+MAX_PAGE_SIZE=1000
+DOWNLOAD_BATCH_SIZE=5000
 SESSION_STORE="/tmp/dorina-{unique_id}"
+# redis keeps results in memory, disk writes them below RESULT_PATH
+RESULT_BACKEND='redis'
+RESULT_PATH="/tmp/dorina-results"
+# webdorina.cleanup: deletion threads, seconds between sweeps for files
+# of missed expiry events, and the age from which files are swept
+CLEANUP_THREADS=4
+CLEANUP_SWEEP_INTERVAL=300
+CLEANUP_MIN_AGE=60
 HOST='0.0.0.0'
 PORT=5000
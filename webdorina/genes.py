@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+In-memory gene search for the autocomplete.
+
+Gene names and their aliases are case folded into a sorted list for
+prefix lookups and a trigram index for substring lookups. Queries of one
+or two letters have no trigram and scan all names instead. Matches are
+ranked exact > prefix > substring, shorter names first.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+
+EXACT, PREFIX, SUBSTRING = range(3)
+
+
+def _trigrams(name):
+    return set(name[i:i + 3] for i in range(len(name) - 2))
+
+
+class GeneIndex(object):
+    """Case-insensitive prefix, substring and alias search over genes"""
+
+    def __init__(self, genes, aliases=None):
+        entries = set((gene.lower(), gene) for gene in genes)
+        for gene, gene_aliases in (aliases or {}).items():
+            entries.update((alias.lower(), gene) for alias in gene_aliases)
+        self._entries = sorted(entries)
+        self._keys = [key for key, _ in self._entries]
+        self._genes = sorted(set(genes))
+        self._trigrams = defaultdict(list)
+        for i, key in enumerate(self._keys):
+            for trigram in _trigrams(key):
+                self._trigrams[trigram].append(i)
+
+    def __len__(self):
+        return len(self._genes)
+
+    def _prefixed(self, query):
+        start = bisect_left(self._keys, query)
+        for i in range(start, len(self._keys)):
+            if not self._keys[i].startswith(query):
+                break
+            yield i
+
+    def _containing(self, query):
+        """Entries containing query"""
+        if len(query) < 3:
+            return (i for i, key in enumerate(self._keys) if query in key)
+        postings = sorted((self._trigrams.get(t, ()) for t in _trigrams(query)),
+                          key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return (i for i in candidates if query in self._keys[i])
+
+    def search(self, query, limit):
+        """Genes matching query, best matches first"""
+        query = query.lower()
+        if not query:
+            return self._genes[:limit]
+
+        ranks = {}
+        for i in self._prefixed(query):
+            key, gene = self._entries[i]
+            rank = EXACT if key == query else PREFIX
+            ranks[gene] = min(rank, ranks.get(gene, rank))
+        for i in self._containing(query):
+            ranks.setdefault(self._entries[i][1], SUBSTRING)
+
+        ranked = sorted(ranks, key=lambda gene: (ranks[gene], len(gene), gene))
+        return ranked[:limit]
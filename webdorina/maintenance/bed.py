@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Streaming BED12 to BED6 conversion, the in-process equivalent of
+`bedtools bed12tobed6`.
+
+Records are read in batches and every block of a BED12 record becomes a
+BED6 record with the name, score and strand of its site. Records with
+less than twelve columns are one block. With numpy the block coordinates
+of a batch are computed at once, without it record by record.
+
+sort_lines() sorts BED lines like `bedSort`, spilling sorted runs to
+temporary files when they don't fit in memory.
+"""
+import heapq
+import tempfile
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_SIZE = 10000
+# lines sorted in memory at once
+SORT_BUFFER = 1000000
+
+
+def records(lines):
+    """Fields of the BED records of lines, skipping headers and comments"""
+    for line in lines:
+        if line.startswith(('#', 'track', 'browser')) or not line.strip():
+            continue
+        yield line.rstrip('\r\n').split('\t')
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _block_lists(fields):
+    """Block sizes and starts of a record, relative to its start"""
+    if len(fields) < 12:
+        return [int(fields[2]) - int(fields[1])], [0]
+    count = int(fields[9])
+    sizes = [int(size) for size in fields[10].rstrip(',').split(',')[:count]]
+    starts = [int(start) for start in fields[11].rstrip(',').split(',')[:count]]
+    return sizes, starts
+
+
+def _coordinates(batch):
+    """Start and end of every block of a batch of records, in order"""
+    counts = []
+    sizes = []
+    offsets = []
+    for fields in batch:
+        block_sizes, block_starts = _block_lists(fields)
+        counts.append(len(block_sizes))
+        sizes.extend(block_sizes)
+        offsets.extend(block_starts)
+
+    if np is None:
+        record_starts = [int(fields[1]) for fields, count in zip(batch, counts)
+                         for _ in range(count)]
+        starts = [start + offset
+                  for start, offset in zip(record_starts, offsets)]
+        return counts, starts, [start + size
+                                for start, size in zip(starts, sizes)]
+
+    record_starts = np.array([fields[1] for fields in batch], dtype=np.int64)
+    starts = np.repeat(record_starts, counts) + np.array(offsets,
+                                                         dtype=np.int64)
+    ends = starts + np.array(sizes, dtype=np.int64)
+    return counts, starts.tolist(), ends.tolist()
+
+
+def bed12_to_bed6(batch):
+    """BED6 lines of the blocks of a batch of records"""
+    counts, starts, ends = _coordinates(batch)
+    lines = []
+    block = 0
+    for fields, count in zip(batch, counts):
+        chrom = fields[0]
+        rest = '\t'.join(fields[3:6])
+        for start, end in zip(starts[block:block + count],
+                              ends[block:block + count]):
+            lines.append('{}\t{}\t{}\t{}\n'.format(chrom, start, end, rest)
+                         if rest else '{}\t{}\t{}\n'.format(chrom, start, end))
+        block += count
+    return lines
+
+
+def convert(lines, out, batch_size=BATCH_SIZE):
+    """Write the BED6 records of BED lines to out
+
+    Returns the number of sites read, a site split into several blocks
+    counts once.
+    """
+    sites = 0
+    for batch in _batches(records(lines), batch_size):
+        out.writelines(bed12_to_bed6(batch))
+        sites += len(batch)
+    return sites
+
+
+def _sort_key(line):
+    fields = line.split('\t', 2)
+    return fields[0], int(fields[1])
+
+
+def sort_lines(lines, out, buffer_size=SORT_BUFFER, tmp_dir=None):
+    """Write BED lines to out, sorted by chromosome and start
+
+    Lines are sorted in runs of buffer_size, which are written to
+    temporary files in tmp_dir and merged when there is more than one.
+    """
+    runs = []
+    try:
+        for batch in _batches(lines, buffer_size):
+            batch.sort(key=_sort_key)
+            if not runs and len(batch) < buffer_size:
+                # it all fits in memory
+                out.writelines(batch)
+                return
+            run = tempfile.TemporaryFile('w+', dir=tmp_dir)
+            run.writelines(batch)
+            run.seek(0)
+            runs.append(run)
+        out.writelines(heapq.merge(*runs, key=_sort_key))
+    finally:
+        for run in runs:
+            run.close()
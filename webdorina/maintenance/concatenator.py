@@ -3,91 +3,193 @@
 """
 Concatenate JSON manifests to provide collections of all related
 experiments.
+
+    python -m webdorina.maintenance.concatenator DATA_PATH
+
+Experiments of all assemblies are concatenated in parallel. An
+`{experiment}_{assembly}_all.bed` is only rebuilt when the mtime and
+content of its inputs changed since the last run, as recorded in the
+`_all.stamp` file next to it.
+
+BED12 blocks are split into BED6 records in process, see
+webdorina.maintenance.bed. `--validate` checks the output against
+`bedtools bed12tobed6`.
 """
 from __future__ import print_function
 from __future__ import unicode_literals
+import argparse
+import hashlib
 import os
 import json
 import glob
 import subprocess
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from itertools import chain, zip_longest
+
+from webdorina.maintenance import bed
+
+BEDTOOLS = "/usr/bin/bedtools"
+
+
+def _digest(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _stamps(filenames, previous):
+    """mtime, size and hash of the inputs, hashing only changed files"""
+    stamps = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        old = previous.get(filename)
+        if old is not None and old[:2] == [stat.st_mtime, stat.st_size]:
+            stamps[filename] = old
+        else:
+            stamps[filename] = [stat.st_mtime, stat.st_size,
+                                _digest(filename)]
+    return stamps
+
+
+def _read_stamp(filename):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def _same_content(stamps, previous):
+    if set(stamps) != set(previous):
+        return False
+    return all(stamps[name][2] == previous[name][2] for name in stamps)
 
-DATA_PATH = os.path.join("/data/projects/doRiNA2/")
-REGULATORS_PATH = os.path.join(DATA_PATH, "regulators")
-OUTPUT_PATH = REGULATORS_PATH  # os.path.join(DATA_PATH, "concats")
-bedtools = os.path.join("/usr/bin/bedtools")
 
+def _bedtools_lines(bed_files, bedtools):
+    for bed_file in bed_files:
+        output = subprocess.check_output(
+            [bedtools, 'bed12tobed6', '-i', bed_file],
+            universal_newlines=True)
+        for line in output.splitlines():
+            yield line
 
-# parse json file and return id and experiment
-def json_parse(json_file):
-    with open(json_file) as data_file:
-        data = json.load(data_file)
-    data_file.close()
-    return data[0]
 
+def validate(bed_files, filename, bedtools=BEDTOOLS):
+    """Compare the BED6 records of filename with those of bedtools
 
-# :: Dict -> String -> String -> String -> IO ()
-def concatenate(table, assembly, source_path, target_path):
-    # bail out if table is empty
-    if not table:
-        return
+    Raises a ValueError at the first differing record.
+    """
+    with open(filename) as fh:
+        ours = bed.records(fh)
+        theirs = bed.records(_bedtools_lines(bed_files, bedtools))
+        for number, (mine, other) in enumerate(
+                zip_longest(ours, theirs), 1):
+            if mine is None or other is None or mine[:6] != other[:6]:
+                raise ValueError('{} differs from bedtools in record {}: '
+                                 '{!r} != {!r}'.format(filename, number,
+                                                       mine, other))
+
+
+# :: String -> String -> [Dict] -> String -> String -> Bool -> Maybe String
+#    -> Maybe String
+def concatenate(experiment, assembly, data_sets, source_path, target_path,
+                force=False, bedtools=None):
+    """Write the _all BED and JSON files of one experiment
+
+    With bedtools, the path of a bedtools binary, the BED file is checked
+    against its conversion. The JSON file records the number of sites.
+    Returns the basename of the written files, None if they were up to
+    date.
+    """
+    basename = os.path.join(
+        target_path, "{0}_{1}_all".format(experiment, assembly))
+    filename_json = basename + '.json'
+    filename_bed = basename + '.bed'
+    filename_stamp = basename + '.stamp'
+
+    json_files = [os.path.join(source_path, j['id'] + '.json')
+                  for j in data_sets]
+    bed_files = [os.path.join(source_path, j['id'] + '.bed')
+                 for j in data_sets]
+
+    previous = _read_stamp(filename_stamp)
+    stamps = _stamps(json_files + bed_files, previous)
+    outputs_exist = os.path.exists(filename_bed) and \
+        os.path.exists(filename_json)
+    if not force and outputs_exist and _same_content(stamps, previous):
+        if stamps != previous:
+            # touched, but unchanged inputs
+            _write_json(filename_stamp, stamps)
+        return None
 
-    # prepare output directory
     if not os.path.exists(target_path):
         os.makedirs(target_path)
 
-    for experiment in table:
-        basename = os.path.join(
-            target_path, "{0}_{1}_all".format(experiment, assembly))
-        filename_json = basename + '.json'
-        filename_bed = basename + '.bed'
-
-        # collect sites count from each json file
-        filenames = [os.path.join(
-            source_path, j['id'] + '.json') for j in table[experiment]]
-        sites = 0
-        for json_file in filenames:
-            data = json_parse(json_file)
-            sites += data['sites']
-
-        # concatenate the associated bed files
-        filenames = [os.path.join(
-            source_path, j['id'] + '.bed') for j in table[experiment]]
-        with open(filename_bed, "w") as f:
-            for bed_file in filenames:
-                out = subprocess.check_output(
-                    [bedtools, 'bed12tobed6', '-i', bed_file])
-                f.write(out)
-                f.flush()
-
-        # create new JSON file for
-        json_contents = [
-            {"id": "{0}_{1}_all".format(experiment, assembly),
-             "experiment": experiment,
-             "summary": "all {} target sites ({})".format(experiment, assembly),
-             "description": "",
-             "methods": "",
-             "references": "",
-             "sites": sites
-             }
-        ]
-
-        with open(filename_json, "w") as f:
-            json.dump(json_contents, f, indent=2)
+    # convert the associated bed files straight into the target file,
+    # counting their sites on the way
+    tmp_bed = filename_bed + '.tmp'
+    try:
+        with open(tmp_bed, "w") as f:
+            sites = bed.convert(chain.from_iterable(
+                _lines(bed_file) for bed_file in bed_files), f)
+        if bedtools is not None:
+            validate(bed_files, tmp_bed, bedtools)
+    except Exception:
+        # open() may have failed before creating it
+        with suppress(FileNotFoundError):
+            os.remove(tmp_bed)
+        raise
+    os.replace(tmp_bed, filename_bed)
+
+    # create new JSON file for
+    json_contents = [
+        {"id": "{0}_{1}_all".format(experiment, assembly),
+         "experiment": experiment,
+         "summary": "all {} target sites ({})".format(experiment, assembly),
+         "description": "",
+         "methods": "",
+         "references": "",
+         "sites": sites
+         }
+    ]
+    _write_json(filename_json, json_contents, indent=2)
+    # the stamp goes last, an interrupted run is redone
+    _write_json(filename_stamp, stamps)
+    return basename
+
+
+def _lines(filename):
+    with open(filename) as fh:
+        for line in fh:
+            yield line
+
+
+def _write_json(filename, contents, **kwargs):
+    with open(filename + '.tmp', "w") as f:
+        json.dump(contents, f, **kwargs)
+    os.replace(filename + '.tmp', filename)
 
 
 # :: String -> Dict
 def gather_experiments(path):
     data_by_experiment = defaultdict(list)
-    for json_file in glob.glob(path + '/*.json'):
+    for json_file in sorted(glob.glob(path + '/*.json')):
         # ignore those files that end on "_all.json"
         if re.match('.*_all.json', json_file):
             print('skipping ' + json_file)
             continue
 
         with open(json_file, "r") as f:
-            data = json.load(f)
+            try:
+                data = json.load(f)
+            except ValueError:
+                print('invalid ' + json_file)
+                continue
 
         # only process those files that have a single data set
         if len(data) == 1:
@@ -99,22 +201,58 @@ def gather_experiments(path):
     return data_by_experiment
 
 
-def walk_tree():
+def walk_tree(regulators_path, output_path=None):
+    """Yield the concatenations of all species and assemblies
+
+    As (experiment, assembly, data sets, source path, target path).
+    """
+    output_path = output_path or regulators_path
     # for each species
-    for species in os.listdir(REGULATORS_PATH):
-        species_path = os.path.join(REGULATORS_PATH, species)
+    for species in sorted(os.listdir(regulators_path)):
+        species_path = os.path.join(regulators_path, species)
+        if not os.path.isdir(species_path):
+            continue
 
         # and for each genome assembly
-        for genome in os.listdir(species_path):
+        for genome in sorted(os.listdir(species_path)):
             genome_path = os.path.join(species_path, genome)
+            if not os.path.isdir(genome_path):
+                continue
 
             # create a big lookup table of all json data by experiment
             table = gather_experiments(genome_path)
+            target_path = os.path.join(output_path, species, genome)
+            for experiment, data_sets in sorted(table.items()):
+                yield experiment, genome, data_sets, genome_path, target_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Concatenate the regulators of each experiment')
+    parser.add_argument('data_path')
+    parser.add_argument('--output-path',
+                        help='defaults to DATA_PATH/regulators')
+    parser.add_argument('--validate', action='store_true',
+                        help='check the output against bedtools')
+    parser.add_argument('--bedtools', default=BEDTOOLS,
+                        help='bedtools binary used by --validate')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='defaults to the number of cores')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild up to date files')
+    args = parser.parse_args()
 
-            # for each of the experiments, create a concatenated json file
-            # containing all data sets
-            target_path = os.path.join(OUTPUT_PATH, species, genome)
-            concatenate(table, genome, genome_path, target_path)
+    regulators_path = os.path.join(args.data_path, 'regulators')
+    with ProcessPoolExecutor(args.processes) as pool:
+        bedtools = args.bedtools if args.validate else None
+        futures = [pool.submit(concatenate, *task, force=args.force,
+                               bedtools=bedtools)
+                   for task in walk_tree(regulators_path, args.output_path)]
+        for future in futures:
+            basename = future.result()
+            if basename is not None:
+                print('wrote ' + basename)
 
 
-walk_tree()
+if __name__ == "__main__":
+    main()
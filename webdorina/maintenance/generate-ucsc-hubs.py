@@ -1,45 +1,51 @@
 #!/usr/bin/env python
 # coding=utf-8
 """
-This script processes a regulator directory hierarchy containing 
+This script processes a regulator directory hierarchy containing
 species, genomes, and associated regulators and produces track hub
 text files for use with the UCSC genome browser.
 
-col 5th must be 0 (zero)
-remove _ (dash) from 1st col
+    generate-ucsc-hubs.py DATA_PATH HUB_PATH
 
-Error line 2027 of /Volumes/prj/trackhubs/dorinaHub/h_sapiens/hg38/PARCLIP_ELAVL1MNASE_hg19.bed.0: name [PARCLIP#ELAVL1MNASE_hg19*NM_001102398_2219_2258NM_001102398_2219_2258NM_001102398_2259_2298NM_001102398_2259_2298NM_001102398_2299_2338NM_001102398_2299_2338NM_001102398_2339_2378NM_001102398_2339_2378NM_001102398_2379_2418NM_001102398_2379_2418NM_001102398_2419_2458NM_001102398_] is too long (must not exceed 255 characters)
-Error line 6499 of /Volumes/prj/trackhubs/dorinaHub/h_sapiens/hg38/PARCLIP_AGO2MNASE_hg19.bed.0: name [PARCLIP#AGO2MNASE_hg19*NM_012342_1095_1134NM_012342_1097_1136NM_012342_1137_1176NM_012342_1142_1181NM_012342_1177_1216NM_012342_1185_1224NM_012342_1225_1264NM_012342_1225_1264NM_012342_1265_1304NM_012342_1276_1315NM_012342_1316_1355NM_012342_1319_1358NM_012342_1359_1398NM_01234] is too long (must not exceed 255 characters)
+Regulators are converted to bigBed in a process pool. A regulator whose
+.bb is newer than its BED file, JSON manifest and chromosome sizes is not
+converted again, so adding a data set only converts that one. The tracks
+of the hub are recorded in HUB_PATH/manifest.json, from which the
+trackDb.txt and genomes.txt files are written.
+
+bedToBigBed requires sorted input, the 5th column to be a 0 and names of
+at most 255 characters. The BED files are sanitised and sorted in a
+single pass into a local temporary file, which bedToBigBed converts:
 
-chmod -R 0755
+Error line 2027 of /Volumes/prj/trackhubs/dorinaHub/h_sapiens/hg38/PARCLIP_ELAVL1MNASE_hg19.bed.0: name [PARCLIP#ELAVL1MNASE_hg19*NM_001102398_2219_2258NM_001102398_2219_2258NM_001102398_2259_2298NM_001102398_2259_2298NM_001102398_2299_2338NM_001102398_2299_2338NM_001102398_2339_2378NM_001102398_2339_2378NM_001102398_2379_2418NM_001102398_2379_2418NM_001102398_2419_2458NM_001102398_] is too long (must not exceed 255 characters)
 
-for f in *.bed.0; /Users/tbrittoborges/bedSort $f $f; /Users/tbrittoborges/bedToBigBed $f  /Volumes/prj/dorina2/genomes/h_sapiens/hg38/hg38.chrom.sizes  (basename $f .bed.0).bb; end
+bedToBigBed is available from
 
+    http://hgdownload.soe.ucsc.edu/admin/exe/
 
-curl http://hgdownload.soe.ucsc.edu/admin/exe/macOSX.x86_64/bedSort
+and the resulting hub can be checked with
 
-~/hubCheck http://porta.dieterichlab.org/trackhubs/dorinaHub/hub.txt
+    hubCheck http://porta.dieterichlab.org/trackhubs/dorinaHub/hub.txt
 """
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import argparse
 import json
 import os
 import subprocess
-import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from io import open
 from pathlib import Path
 from subprocess import CalledProcessError
 
-DATA_PATH = Path("/Volumes/prj/dorina2/")
-HUB_PATH = Path("/Volumes/prj/trackhubs/dorinaHub/")
-GENOMES_PATH = Path(DATA_PATH / "genomes/")
-REGULATORS_PATH = Path(DATA_PATH, "regulators")
-HUB_GENOMES = []  # genomes.txt
+from webdorina.maintenance import bed
 
-# kent executables
-bedToBigBed = Path("/Users/tbrittoborges/bedToBigBed")
-bedSort = Path("/Users/tbrittoborges/bedSort")
+# kent executable
+BED_TO_BIG_BED = "bedToBigBed"
+
+MANIFEST = "manifest.json"
 
 
 # parse json file and return id and experiment
@@ -57,64 +63,95 @@ def write_html_description(path, json_file):
                 desc_file.write(str(json_file[field]) + '\n')
 
 
-def convert_bed_to_bigbed(bed_path, bb_path, remove_scores_path, coordinates):
+def sanitise(lines, bed_path):
+    """BED6 lines with zero scores and names bedToBigBed accepts
+
+    Lines without a name or numeric coordinates are skipped, their count
+    is reported at the end.
+    """
+    skipped = 0
+    for line in lines:
+        fields = line.rstrip().split('\t')
+        try:
+            # bedToBigBed and the sort need numbers
+            int(fields[1]), int(fields[2])
+            # Replace score field with "0"
+            # trims the name field
+
+            if len(fields) > 4:
+                sanitised = '\t'.join(fields[0:3] + [fields[3][:254]]
+                                      + ["0"] + [fields[5]]) + '\n'
+            else:
+                # bed file without strand HITSCLIP_FOX2Yeo2009_hg19.bed
+                sanitised = '\t'.join(fields[0:3] + [fields[3][:254]]
+                                      + ["0", '+']) + '\n'
+
+        except (IndexError, ValueError):
+            print(">>>>> ERROR: problematic line in " + str(
+                bed_path) + line)
+            skipped += 1
+            continue
+        yield sanitised
+    if skipped:
+        print(">>>>> SKIPPED {} lines of {}".format(skipped, bed_path))
+
+
+def convert_bed_to_bigbed(bed_path, bb_path, coordinates,
+                          bed_to_big_bed=BED_TO_BIG_BED, tmp_dir=None,
+                          buffer_size=bed.SORT_BUFFER):
     print(">>>>> START " + str(bed_path))
+    # sanitise and sort in one pass into a local file, bedToBigBed reads
+    # its input twice so it can't be a pipe
+    with tempfile.NamedTemporaryFile('w', suffix='.bed', dir=tmp_dir,
+                                     delete=False) as file_out:
+        sorted_path = file_out.name
     try:
-        with open(bed_path) as file_in, \
-                open(remove_scores_path, 'w') as file_out:
-            for line in file_in:
-                fields = line.rstrip().split('\t')
-                try:
-                    # Replace score field with "0"
-                    # trims the name field
-
-                    if len(fields) > 4:
-                        new_line = '\t'.join(fields[0:3] + [fields[3][:254]]
-                                             + ["0"] + [fields[5]]) + '\n'
-                    else:
-                        # bed file without strand HITSCLIP_FOX2Yeo2009_hg19.bed
-                        new_line = '\t'.join(fields[0:3] + [fields[3][:254]]
-                                             + ["0", '+']) + '\n'
-
-                except IndexError:
-                    print(">>>>> ERROR: problematic line in " + str(
-                        bed_path) + line)
-                    continue
+        with open(bed_path) as file_in, open(sorted_path, 'w') as file_out:
+            bed.sort_lines(sanitise(file_in, bed_path), file_out,
+                           buffer_size, tmp_dir)
+
+        # convert into a temporary file, a failed conversion leaves no .bb
+        # which looks up to date
+        tmp_path = bb_path.with_suffix(".bb.tmp")
+        subprocess.check_call([bed_to_big_bed, sorted_path,
+                               str(coordinates), str(tmp_path)])
+    finally:
+        os.remove(sorted_path)
+    tmp_path.replace(bb_path)
+    print(">>>>> DONE " + str(bb_path))
+    return str(bb_path)
 
-                file_out.write(new_line)
 
-        # sort file
-        subprocess.call([bedSort, remove_scores_path, remove_scores_path])
-        # convert
-        subprocess.call([bedToBigBed, remove_scores_path, coordinates, bb_path])
-        print(">>>>> DONE " + str(bb_path))
-    except CalledProcessError as e:
-        print("BigBedConversionError: ", e, bed_path)
+def up_to_date(bb_path, *sources):
+    """Whether bb_path is newer than all of its sources"""
+    if not bb_path.exists():
+        return False
+    mtime = bb_path.stat().st_mtime
+    return all(source.stat().st_mtime <= mtime for source in sources)
 
 
-def process_hierarchy(root):
+def _dirs(path):
+    return sorted(p.name for p in path.iterdir() if p.is_dir())
+
+
+def collect_tracks(regulators_path, genomes_path, hub_path):
     """
     Traverse a hierarchy of species/genomes/regulators, converting
     metadata from JSON manifests into track information.
+
+    Yields a dict per regulator with its track entry and the paths of its
+    conversion.
     """
-    root = Path(root)
-    for sp in (r.name for r in root.iterdir() if r.is_dir()):
-        # trackDb.txt
-        parents = []
-        track_parents_entry = []
-        track_slaves_entry = []
-
-        # browse for all genomes
-        for genome in (g.name for g in (
-                    GENOMES_PATH / sp).iterdir() if g.is_dir()):
-
-            # create target dir for genome
-            hub_dir = Path(HUB_PATH) / sp / genome
-            if not hub_dir.exists():
-                hub_dir.mkdir(parents=True)
+    for sp in _dirs(regulators_path):
+        for genome in _dirs(regulators_path / sp):
+            coordinates = (genomes_path / sp / genome / genome).with_suffix(
+                ".genome")
+            if not coordinates.exists():
+                print('no chromosome sizes for {}, skipping'.format(genome))
+                continue
 
             # for all files with metadata in current genome
-            for f in (root / sp / genome).iterdir():
+            for f in sorted((regulators_path / sp / genome).iterdir()):
 
                 # only work on json manifests
                 if f.suffix != ".json":
@@ -123,10 +160,15 @@ def process_hierarchy(root):
                     continue
 
                 try:
-                    json_info = json_parse(root / sp / genome / f)
-                except KeyError:
-                    print('error with {}'.format(root / sp / genome / f))
-                    sys.exit(0)
+                    json_info = json_parse(f)
+                except (KeyError, IndexError, ValueError):
+                    print('error with {}'.format(f))
+                    continue
+
+                bed_path = f.with_suffix(".bed")
+                if not bed_path.exists():
+                    print('no BED file for {}'.format(f))
+                    continue
 
                 parent = json_info['experiment'].replace(' ', '-')
                 if "miRNA" in parent:
@@ -134,77 +176,157 @@ def process_hierarchy(root):
                 else:
                     long_label = json_info['summary'].replace("\n", ' ')
 
-                # run conversion only for associated bed files
-                data_file_type = "bigBed"
-                data_file_ext = "bb"
-                bed_path = (root / sp / genome / f.stem).with_suffix(".bed")
-                bb_path = (hub_dir / f.stem).with_suffix(".bb")
-                remove_scores_path = (hub_dir / f.stem).with_suffix(".bed.0")
-                coordinates = (GENOMES_PATH / sp / genome / genome).with_suffix(
-                    ".genome")
-                try:
-                    convert_bed_to_bigbed(bed_path,
-                                          bb_path,
-                                          remove_scores_path,
-                                          coordinates)
-                except CalledProcessError:
-                    continue
-
-                # add parent track entry
-                # experiment name for the first json entry
-                if json_info['experiment'] not in parents and \
-                                parent not in parents:
-                    parents.append(parent)
-                    track_parents_entry.append([
-                        "track " + parent + '-p',
-                        "superTrack on",
-                        "shortLabel " + parent,
-                        "longLabel " + parent,
-                    ])
-
-                track_info = [
-                    "track " + f.stem,
-                    "parent " + parent + '-p',
-                    "bigDataUrl " + str(f.stem) + '.' + data_file_ext,
-                    "shortLabel " + str(f.stem).replace(genome, ''),
-                    "longLabel " + long_label,
-                    "type " + data_file_type + " 6",
-                    "html " + str(f.stem),
-                    'visibility squish']
-
-                if 'autoScale' in json_info and json_info['autoScale'] == 'on':
-                    track_info.append("autoScale on")
-
-                # add child track entry
-                track_slaves_entry.append(track_info)
-
-                # write html desc file
-                write_html_description(
-                    json_file=json_info,
-                    path=(hub_dir / f.stem).with_suffix(".html"))
-
-            with open(hub_dir / Path("trackDb.txt"), "w") as track_file:
-                for p in track_parents_entry:
-                    for e in p:
-                        track_file.write(e + "\n")
-                    track_file.write("\n")
-                for s in track_slaves_entry:
-                    for e in s:
-                        track_file.write(e + "\n")
-                    track_file.write("\n")
-            track_file.close()
-
-            # gather information for genomes.txt
-            HUB_GENOMES.append(["genome " + str(genome) + "\n" + "trackDb " +
-                                str(sp) + "/" + str(genome) + "/trackDb.txt\n"])
-
-
-# start
-process_hierarchy(REGULATORS_PATH)
-
-# write genomes.txt
-with open(os.path.join(HUB_PATH, "genomes.txt"), "w") as track_genomes_file:
-    for g in HUB_GENOMES:
-        track_genomes_file.write(g[0])
-        track_genomes_file.write("\n")
-track_genomes_file.close()
+                hub_dir = hub_path / sp / genome
+                yield dict(
+                    species=sp,
+                    genome=genome,
+                    track=f.stem,
+                    parent=parent,
+                    long_label=long_label,
+                    auto_scale=json_info.get('autoScale') == 'on',
+                    json_info=json_info,
+                    json_path=f,
+                    bed_path=bed_path,
+                    bb_path=(hub_dir / f.stem).with_suffix(".bb"),
+                    coordinates=coordinates)
+
+
+def track_db(tracks, genome):
+    """Lines of the trackDb.txt of the tracks of a genome"""
+    data_file_type = "bigBed"
+    data_file_ext = "bb"
+    parents = []
+    track_parents_entry = []
+    track_slaves_entry = []
+    for track in tracks:
+        parent = track['parent']
+        # add parent track entry
+        # experiment name for the first json entry
+        if parent not in parents:
+            parents.append(parent)
+            track_parents_entry.append([
+                "track " + parent + '-p',
+                "superTrack on",
+                "shortLabel " + parent,
+                "longLabel " + parent,
+            ])
+
+        track_info = [
+            "track " + track['track'],
+            "parent " + parent + '-p',
+            "bigDataUrl " + track['track'] + '.' + data_file_ext,
+            "shortLabel " + track['track'].replace(genome, ''),
+            "longLabel " + track['long_label'],
+            "type " + data_file_type + " 6",
+            "html " + track['track'],
+            'visibility squish']
+
+        if track['auto_scale']:
+            track_info.append("autoScale on")
+
+        # add child track entry
+        track_slaves_entry.append(track_info)
+
+    for entry in track_parents_entry + track_slaves_entry:
+        for e in entry:
+            yield e + "\n"
+        yield "\n"
+
+
+def write_hub(hub_path, manifest):
+    """Write trackDb.txt of every genome and genomes.txt of a manifest"""
+    for genome_entry in manifest:
+        hub_dir = hub_path / genome_entry['species'] / genome_entry['genome']
+        with open(hub_dir / "trackDb.txt", "w") as track_file:
+            track_file.writelines(track_db(genome_entry['tracks'],
+                                           genome_entry['genome']))
+
+    with open(hub_path / "genomes.txt", "w") as track_genomes_file:
+        for genome_entry in manifest:
+            track_genomes_file.write(
+                "genome {genome}\n"
+                "trackDb {species}/{genome}/trackDb.txt\n\n".format(
+                    **genome_entry))
+
+
+def build_hub(data_path, hub_path, processes=None, force=False,
+              bed_to_big_bed=BED_TO_BIG_BED, tmp_dir=None):
+    """Convert the stale regulators and write the hub, returns the manifest
+
+    Regulators whose conversion fails are left out of the hub.
+    """
+    data_path = Path(data_path)
+    hub_path = Path(hub_path)
+    if not hub_path.exists():
+        hub_path.mkdir(parents=True)
+    tracks = list(collect_tracks(data_path / "regulators",
+                                 data_path / "genomes", hub_path))
+
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {}
+        for track in tracks:
+            hub_dir = track['bb_path'].parent
+            if not hub_dir.exists():
+                hub_dir.mkdir(parents=True)
+            # write html desc file
+            write_html_description(
+                json_file=track['json_info'],
+                path=(hub_dir / track['track']).with_suffix(".html"))
+
+            if force or not up_to_date(track['bb_path'], track['bed_path'],
+                                       track['json_path'],
+                                       track['coordinates']):
+                futures[track['track'], track['genome']] = pool.submit(
+                    convert_bed_to_bigbed, track['bed_path'], track['bb_path'],
+                    track['coordinates'], bed_to_big_bed, tmp_dir)
+
+        failed = set()
+        for key, future in futures.items():
+            try:
+                future.result()
+            # ValueError: a BED file that isn't UTF-8 text
+            except (CalledProcessError, IOError, ValueError) as e:
+                print("BigBedConversionError: ", e, key[0])
+                failed.add(key)
+
+    manifest = []
+    for track in tracks:
+        if (track['track'], track['genome']) in failed:
+            continue
+        if not manifest or manifest[-1]['genome'] != track['genome'] or \
+                manifest[-1]['species'] != track['species']:
+            manifest.append(dict(species=track['species'],
+                                 genome=track['genome'], tracks=[]))
+        manifest[-1]['tracks'].append(
+            {key: track[key] for key in ('track', 'parent', 'long_label',
+                                         'auto_scale')})
+
+    with open(hub_path / (MANIFEST + ".tmp"), "w") as manifest_file:
+        manifest_file.write(json.dumps(manifest, indent=2))
+    (hub_path / (MANIFEST + ".tmp")).replace(hub_path / MANIFEST)
+    write_hub(hub_path, manifest)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the UCSC track hub of the regulators')
+    parser.add_argument('data_path',
+                        help='directory with the regulators and genomes')
+    parser.add_argument('hub_path')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='defaults to the number of cores')
+    parser.add_argument('--force', action='store_true',
+                        help='convert regulators which are up to date')
+    parser.add_argument('--bedToBigBed', dest='bed_to_big_bed',
+                        default=BED_TO_BIG_BED)
+    parser.add_argument('--tmp-dir',
+                        help='local directory for the sorted BED files, '
+                             'defaults to the system temporary directory')
+    args = parser.parse_args()
+    build_hub(args.data_path, args.hub_path, args.processes, args.force,
+              args.bed_to_big_bed, args.tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
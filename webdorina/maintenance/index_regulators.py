@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Build the memory-mapped site indexes of all regulator BED files, see
+webdorina.sites. Up to date indexes are skipped.
+
+    python -m webdorina.maintenance.index_regulators DATA_PATH
+"""
+from __future__ import print_function
+import argparse
+import glob
+import os
+import sys
+
+from webdorina import sites
+
+
+def index_regulators(data_path, force=False):
+    """Index the BED files below DATA_PATH/regulators, yields their paths"""
+    pattern = os.path.join(data_path, 'regulators', '*', '*', '*.bed')
+    for bed_path in sorted(glob.glob(pattern)):
+        if force or not sites.up_to_date(bed_path):
+            sites.build_index(bed_path)
+            yield bed_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index regulator sites for the analysis workers')
+    parser.add_argument('data_path')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild indexes which are up to date')
+    args = parser.parse_args()
+    if sites.np is None:
+        sys.exit('building site indexes needs numpy')
+    for bed_path in index_regulators(args.data_path, args.force):
+        print('indexed {}'.format(bed_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Compressed storage for dorina results and their cache keys.
+
+Results are split into blocks of `block_size` rows, each block zlib
+compressed. Readers only fetch and decompress the blocks covering the
+rows they need. Every result has a Redis hash under its key whose
+`rows` and `block_size` fields form the header.
+
+A result can also be written while it is produced, see ResultWriter.
+Readers then see every complete block right away, and the header has
+a `running` field until the last rows are stored.
+
+Every write also replaces the gene index of the result, a hash under
+gene_index_key() mapping gene IDs to their row offsets, in the same
+transaction as the header. Results written without an index drop any
+index of an older result under the same key.
+
+Two backends are available:
+
+redis
+    the blocks are stored in the Redis hash next to the header, under
+    their block number
+disk
+    the blocks are written to a new file below RESULT_PATH on every
+    write, followed by an index of block offsets; Redis only keeps the
+    header and the path. Running results keep their blocks in the hash
+    until they complete.
+"""
+import abc
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+BLOCK_SIZE = 1000
+# blocks sent to Redis in one pipeline while writing
+WRITE_BATCH = 50
+
+
+# query fields which are irrelevant when they hold these values
+QUERY_DEFAULTS = dict(match_a='any', region_a='any', match_b='any',
+                      region_b='any', combine='or', tissue=None)
+SET_B_FIELDS = ('match_b', 'region_b', 'window_b', 'combine')
+
+
+def _members(values):
+    """Sorted, deduplicated members of a set valued query field"""
+    if not values:
+        return None
+    return sorted(set(values))
+
+
+def canonical_query(query):
+    """Return the canonical form of a search query
+
+    Set valued fields are sorted and deduplicated, since their order
+    doesn't change the analysis, and fields holding their default value
+    or only relevant to an absent set B are dropped.
+    """
+    canonical = dict(query)
+    genes = _members(query.get('genes'))
+    canonical['genes'] = [u'all'] if not genes or u'all' in genes else genes
+    for field in ('set_a', 'set_b', 'tissue'):
+        canonical[field] = _members(query.get(field))
+
+    if canonical['set_b'] is None:
+        for field in SET_B_FIELDS:
+            canonical.pop(field, None)
+    elif len(canonical['set_b']) == 1:
+        # with a single regulator 'any' and 'all' match the same genes
+        canonical.pop('match_b', None)
+    if canonical['set_a'] and len(canonical['set_a']) == 1:
+        canonical.pop('match_a', None)
+
+    for field, default in QUERY_DEFAULTS.items():
+        if field in canonical and canonical[field] == default:
+            del canonical[field]
+    return canonical
+
+
+def sub_queries(query):
+    """Split a combinatorial query into its set A and set B queries"""
+    query_a = dict(query, set_b=None)
+    query_b = dict(query, set_a=query['set_b'], set_b=None,
+                   match_a=query['match_b'], region_a=query['region_b'])
+    query_b.pop('window_a', None)
+    if 'window_b' in query:
+        query_b['window_a'] = query['window_b']
+    for sub_query in (query_a, query_b):
+        for field in SET_B_FIELDS:
+            sub_query.pop(field, None)
+    return query_a, query_b
+
+
+def result_key(query):
+    """Fixed length cache key shared by all equivalent queries"""
+    canonical = json.dumps(canonical_query(query), sort_keys=True)
+    return 'results:{0}'.format(
+        hashlib.sha1(canonical.encode('utf-8')).hexdigest())
+
+
+def gene_index_key(key):
+    return '{0}_genes'.format(key)
+
+
+def _set_index(pipe, key, index, ttl):
+    """Queue replacing the gene index of key, removing it if index is None
+
+    index maps gene IDs to comma separated row offsets.
+    """
+    index_key = gene_index_key(key)
+    pipe.delete(index_key)
+    if not index:
+        return
+    genes = list(index)
+    for i in range(0, len(genes), 1000):
+        pipe.hset(index_key, mapping=dict(
+            (gene, index[gene]) for gene in genes[i:i + 1000]))
+    pipe.expire(index_key, ttl)
+
+
+def _pack(lines):
+    return zlib.compress('\n'.join(lines).encode('utf-8'))
+
+
+def _unpack(block):
+    return zlib.decompress(block).decode('utf-8').split('\n')
+
+
+def _blocks(lines, block_size):
+    """Split an iterable of rows into compressed blocks"""
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) == block_size:
+            yield len(block), _pack(block)
+            block = []
+    if block:
+        yield len(block), _pack(block)
+
+
+def block_numbers(rows, block_size, start, stop):
+    """Numbers of the blocks holding rows[start:stop]"""
+    if stop is None or stop > rows:
+        stop = rows
+    if start >= stop:
+        return []
+    return list(range(start // block_size, (stop - 1) // block_size + 1))
+
+
+def slice_blocks(blocks, first, block_size, start, stop):
+    """Rows[start:stop] out of consecutive blocks starting at block first"""
+    lines = [line for block in blocks for line in _unpack(block)]
+    offset = first * block_size
+    return lines[start - offset:None if stop is None else stop - offset]
+
+
+_index_count = struct.Struct('<Q')
+
+
+def read_file_blocks(filename, numbers):
+    """Compressed blocks with the given numbers out of a result file"""
+    with open(filename, 'rb') as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            count_at = len(data) - _index_count.size
+            num_blocks, = _index_count.unpack(data[count_at:])
+            index = struct.Struct('<{0}Q'.format(num_blocks + 1))
+            offsets = index.unpack(data[count_at - index.size:count_at])
+            return [data[offsets[n]:offsets[n + 1]]
+                    if n < num_blocks else None for n in numbers]
+        finally:
+            data.close()
+
+
+class ResultStore(abc.ABC):
+    """Result rows stored as compressed blocks
+
+    The connection must not decode responses, blocks are binary.
+    Subclasses implement write() and _load().
+    """
+
+    def __init__(self, connection, block_size=BLOCK_SIZE):
+        self.conn = connection
+        self.block_size = block_size
+
+    def exists(self, key):
+        return bool(self.conn.exists(key))
+
+    def expire(self, key, ttl):
+        self.conn.expire(key, ttl)
+
+    def _header(self, key):
+        rows, block_size = self.conn.hmget(key, 'rows', 'block_size')
+        if rows is None:
+            return 0, self.block_size
+        return int(rows), int(block_size)
+
+    def count(self, key):
+        return self._header(key)[0]
+
+    def running(self, key):
+        """Whether the result under key is still being written"""
+        return self.conn.hget(key, 'running') is not None
+
+    def complete(self, key):
+        """Whether a complete result is stored under key"""
+        rows, running = self.conn.hmget(key, 'rows', 'running')
+        return rows is not None and running is None
+
+    @abc.abstractmethod
+    def write(self, key, lines, ttl, index=None):
+        """Store an iterable of rows under key, replacing any old result
+
+        index is the gene index of the rows, see _set_index().
+        """
+
+    @abc.abstractmethod
+    def _load(self, key, numbers):
+        """Return the compressed blocks with the given numbers"""
+
+    def writer(self, key, ttl):
+        """Return a ResultWriter replacing the result under key"""
+        return ResultWriter(self, key, ttl)
+
+    def _finish(self, key, num_blocks, ttl, index=None):
+        """Mark a result written by a ResultWriter as complete"""
+        pipe = self.conn.pipeline()
+        pipe.hdel(key, 'running')
+        pipe.expire(key, ttl)
+        _set_index(pipe, key, index, ttl)
+        pipe.execute()
+
+    def read(self, key, start=0, stop=None):
+        """Return rows[start:stop] of the result stored under key"""
+        rows, block_size = self._header(key)
+        numbers = block_numbers(rows, block_size, start, stop)
+        if not numbers:
+            return []
+        return slice_blocks(self._load(key, numbers), numbers[0], block_size,
+                            start, stop)
+
+    def rows(self, key, offsets):
+        """Return the rows at the given sorted offsets"""
+        rows, block_size = self._header(key)
+        offsets = [o for o in offsets if o < rows]
+        needed = sorted(set(o // block_size for o in offsets))
+        if not needed:
+            return []
+        blocks = dict(zip(needed, self._load(key, needed)))
+        unpacked = {}
+        result = []
+        for offset in offsets:
+            n = offset // block_size
+            if n not in unpacked:
+                unpacked[n] = _unpack(blocks[n])
+            result.append(unpacked[n][offset % block_size])
+        return result
+
+    def iter_rows(self, key, batch_size=BLOCK_SIZE * 5):
+        """Yield the stored rows in lists of about batch_size rows"""
+        rows, block_size = self._header(key)
+        num_blocks = -(-rows // block_size)
+        step = max(batch_size // block_size, 1)
+        for first in range(0, num_blocks, step):
+            numbers = list(range(first, min(first + step, num_blocks)))
+            lines = []
+            for block in self._load(key, numbers):
+                if block is not None:
+                    lines.extend(_unpack(block))
+            if lines:
+                yield lines
+
+
+class RedisResultStore(ResultStore):
+    """Blocks kept in the Redis hash next to the header"""
+
+    def write(self, key, lines, ttl, index=None):
+        """Store an iterable of rows under key, replacing any old result
+
+        Blocks go to a temporary key which is renamed once complete, so
+        readers never see a partially written result.
+        """
+        tmp_key = '{0}_tmp'.format(key)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete(tmp_key)
+        rows = 0
+        for n, (num_rows, block) in enumerate(_blocks(lines, self.block_size)):
+            pipe.hset(tmp_key, n, block)
+            rows += num_rows
+            if (n + 1) % WRITE_BATCH == 0:
+                pipe.execute()
+        pipe.execute()
+        pipe = self.conn.pipeline()
+        pipe.hset(tmp_key, mapping=dict(rows=rows, block_size=self.block_size))
+        pipe.rename(tmp_key, key)
+        pipe.expire(key, ttl)
+        _set_index(pipe, key, index, ttl)
+        pipe.execute()
+        return rows
+
+    def _load(self, key, numbers):
+        return self.conn.hmget(key, numbers)
+
+
+class FileResultStore(ResultStore):
+    """Blocks kept in a file, Redis only holds the header and the path
+
+    The file holds the compressed blocks followed by their byte offsets
+    (one more than there are blocks) as little endian uint64 and the
+    number of blocks. Reads memory-map the file and slice out blocks.
+
+    Files are named after the key and a random write id, so a result
+    written again goes to a new file and readers holding the old header
+    keep reading the old file. Files no header points at are removed by
+    purge() once they are min_age seconds old.
+    """
+    def __init__(self, connection, path, block_size=BLOCK_SIZE):
+        super(FileResultStore, self).__init__(connection, block_size)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _prefix(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return os.path.join(self.path,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def files_for(self, key):
+        """Result files of key, of its current and any older writes"""
+        return sorted(glob.glob(self._prefix(key) + '.*.blocks'))
+
+    def write(self, key, lines, ttl, index=None):
+        """Store an iterable of rows under key, replacing any old result
+
+        The file is written under a temporary name and moved in place
+        before the header points at it.
+        """
+        rows = [0]
+
+        def count_rows():
+            for num_rows, block in _blocks(lines, self.block_size):
+                rows[0] += num_rows
+                yield block
+
+        filename = self._write_file(key, count_rows())
+        pipe = self.conn.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=dict(rows=rows[0], block_size=self.block_size,
+                                    path=filename))
+        pipe.expire(key, ttl)
+        _set_index(pipe, key, index, ttl)
+        pipe.execute()
+        return rows[0]
+
+    def _write_file(self, key, blocks):
+        """Write compressed blocks and their index to a new file of key"""
+        filename = '{0}.{1}.blocks'.format(self._prefix(key),
+                                           os.urandom(8).hex())
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        offsets = [0]
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for block in blocks:
+                    out.write(block)
+                    offsets.append(offsets[-1] + len(block))
+                out.write(struct.pack('<{0}Q'.format(len(offsets)), *offsets))
+                out.write(_index_count.pack(len(offsets) - 1))
+            os.replace(tmp_name, filename)
+        except Exception:
+            os.remove(tmp_name)
+            raise
+        return filename
+
+    def _load(self, key, numbers):
+        # one command, a result completing in between is read either way
+        values = self.conn.hmget(key, ['path'] + list(numbers))
+        if values[0] is None:
+            # running results keep their blocks in the hash
+            return values[1:]
+        return read_file_blocks(values[0], numbers)
+
+    def _finish(self, key, num_blocks, ttl, index=None):
+        """Move the blocks of a completed result from Redis to disk"""
+        numbers = list(range(num_blocks))
+        filename = self._write_file(key, (
+            block for first in range(0, num_blocks, WRITE_BATCH)
+            for block in self.conn.hmget(
+                key, numbers[first:first + WRITE_BATCH])))
+        pipe = self.conn.pipeline()
+        pipe.hset(key, 'path', filename)
+        if numbers:
+            pipe.hdel(key, *numbers)
+        pipe.hdel(key, 'running')
+        pipe.expire(key, ttl)
+        _set_index(pipe, key, index, ttl)
+        pipe.execute()
+
+    def purge(self, min_age=60):
+        """Remove result files whose Redis header has expired
+
+        Files younger than min_age seconds are kept, they may still be
+        waiting for their header. Yields the name and size of the removed
+        files.
+        """
+        live = set()
+        for key in self.conn.scan_iter(match='results:*'):
+            if self.conn.type(key) in (b'hash', 'hash'):
+                filename = self.conn.hget(key, 'path')
+                if filename is not None:
+                    live.add(os.fsdecode(filename))
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if filename in live:
+                continue
+            try:
+                stat = os.stat(filename)
+                if stat.st_mtime > time.time() - min_age:
+                    continue
+                os.remove(filename)
+            except OSError:
+                continue
+            yield filename, stat.st_size
+
+
+class ResultWriter(object):
+    """Store a result block by block while it is produced
+
+    Rows are buffered until they fill a block, readers see the rows of
+    all complete blocks. The `running` header field is removed by
+    close(), which also stores the last, partial block.
+    """
+
+    def __init__(self, store, key, ttl):
+        self.store = store
+        self.key = key
+        self.ttl = ttl
+        self.rows = 0
+        self.blocks = 0
+        self._buffer = []
+        pipe = store.conn.pipeline()
+        pipe.delete(key)
+        # rows of the new result must not be looked up in an old index
+        pipe.delete(gene_index_key(key))
+        pipe.hset(key, mapping=dict(rows=0, block_size=store.block_size,
+                                    running=1))
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+    def append(self, lines):
+        """Add rows, returns the number of rows readers can see"""
+        self._buffer.extend(lines)
+        block_size = self.store.block_size
+        full = len(self._buffer) // block_size * block_size
+        if full:
+            self._flush(self._buffer[:full])
+            del self._buffer[:full]
+        return self.rows
+
+    def _flush(self, lines):
+        pipe = self.store.conn.pipeline(transaction=False)
+        for num_rows, block in _blocks(lines, self.store.block_size):
+            pipe.hset(self.key, self.blocks, block)
+            self.blocks += 1
+            self.rows += num_rows
+            if self.blocks % WRITE_BATCH == 0:
+                pipe.execute()
+        # blocks first, readers never see rows without their block
+        pipe.hset(self.key, 'rows', self.rows)
+        pipe.execute()
+
+    def close(self, index=None):
+        """Store the remaining rows and mark the result complete
+
+        index is the gene index of all rows, see _set_index().
+        """
+        if self._buffer:
+            self._flush(self._buffer)
+            self._buffer = []
+        self.store._finish(self.key, self.blocks, self.ttl, index)
+        return self.rows
+
+
+def make_store(connection, backend='redis', path=None,
+               block_size=BLOCK_SIZE):
+    """Return the result store for the configured RESULT_BACKEND"""
+    if backend == 'redis':
+        return RedisResultStore(connection, block_size)
+    elif backend == 'disk':
+        return FileResultStore(connection, path, block_size)
+    raise ValueError('Unknown result backend {0!r}'.format(backend))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Memory-mapped indexes of regulator sites.
+
+Next to a regulator `{name}.bed`, `{name}.sites.npy` holds the sorted
+start and end coordinates of its sites per chromosome and strand and
+`{name}.sites.idx` the JSON table of where each chromosome and strand
+starts in that array. Build them with
+
+    python -m webdorina.maintenance.index_regulators DATA_PATH
+
+The arrays are memory-mapped, so all workers on a host share their
+pages, and overlap counts are binary searches. numpy is optional, without
+it or without an up to date index load() returns None.
+"""
+import json
+import os
+import threading
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _paths(bed_path):
+    basename = os.path.splitext(bed_path)[0]
+    return basename + '.sites.npy', basename + '.sites.idx'
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class SiteIndex(object):
+    """Sorted site coordinates of a regulator by chromosome and strand"""
+
+    def __init__(self, array_path, table_path):
+        with open(table_path) as fh:
+            self.table = json.load(fh)
+        # empty arrays can't be memory-mapped
+        self.data = np.load(array_path, mmap_mode='r' if self.table else None)
+
+    def chromosomes(self):
+        return set(key.split('\t')[0] for key in self.table)
+
+    def count(self, chrom, starts, ends):
+        """Number of sites overlapping each of the intervals on chrom
+
+        Intervals are closed, as in GFF files. Sites on either strand are
+        counted.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        total = np.zeros(len(starts), dtype=np.int64)
+        for key, (offset, size) in self.table.items():
+            if key.split('\t')[0] != chrom:
+                continue
+            site_starts = self.data[offset:offset + size]
+            site_ends = self.data[offset + size:offset + 2 * size]
+            # sites starting before an interval ends, minus those which
+            # also ended before it starts
+            total += np.searchsorted(site_starts, ends, side='right')
+            total -= np.searchsorted(site_ends, starts, side='left')
+        return total
+
+
+def build_index(bed_path):
+    """Write the site index of a regulator BED file"""
+    sites = defaultdict(list)
+    with open(bed_path) as bed:
+        for line in bed:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            cols = line.rstrip('\n').split('\t')
+            strand = cols[5] if len(cols) > 5 else '.'
+            sites[cols[0] + '\t' + strand].append(
+                (int(cols[1]), int(cols[2])))
+
+    table = {}
+    arrays = []
+    offset = 0
+    for key in sorted(sites):
+        coords = np.array(sites[key], dtype=np.int64)
+        arrays.append(np.sort(coords[:, 0]))
+        arrays.append(np.sort(coords[:, 1]))
+        table[key] = (offset, len(coords))
+        offset += 2 * len(coords)
+    data = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+
+    array_path, table_path = _paths(bed_path)
+    # np.save appends .npy to names without it
+    tmp_array = array_path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_array, data)
+    os.replace(tmp_array, array_path)
+    with open(table_path + '.tmp', 'w') as fh:
+        json.dump(table, fh)
+    os.replace(table_path + '.tmp', table_path)
+    return array_path
+
+
+def up_to_date(bed_path):
+    """Whether the site index of a BED file is at least as recent"""
+    bed_mtime = _mtime(bed_path)
+    mtimes = [_mtime(path) for path in _paths(bed_path)]
+    return None not in mtimes and bed_mtime is not None and \
+        min(mtimes) >= bed_mtime
+
+
+def load(bed_path):
+    """The SiteIndex of a BED file, None if missing, stale or no numpy"""
+    if np is None or not up_to_date(bed_path):
+        return None
+    array_path, table_path = _paths(bed_path)
+    version = (_mtime(array_path), _mtime(table_path))
+    cached = _indexes.get(bed_path)
+    if cached is None or cached[0] != version:
+        with _lock:
+            cached = _indexes.get(bed_path)
+            if cached is None or cached[0] != version:
+                cached = (version, SiteIndex(array_path, table_path))
+                _indexes[bed_path] = cached
+    return cached[1]
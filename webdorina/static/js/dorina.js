@@ -134,10 +134,16 @@ function DoRiNAResult(line) {
 
 }
 
-function DoRiNAViewModel(net, uuid, custom_regulator) {
+function DoRiNAViewModel(net, uuid, custom_regulator, status_streams) {
     var self = this;
     self.mode = ko.observable("choose_db");
     self.retry_after = 10000;
+    // get status updates pushed by the server instead of polling, if it
+    // serves status streams without tying up a worker per stream
+    self.use_events = Boolean(status_streams) &&
+        typeof EventSource !== 'undefined';
+    // the results table shows the first rows of a running job
+    self.partial_results = false;
     self.loading_regulators = ko.observable(false);
     self.uuid = ko.observable(uuid);
     self.custom_regulator = ko.observable(custom_regulator);
@@ -518,24 +524,63 @@ function DoRiNAViewModel(net, uuid, custom_regulator) {
     };
 
     self.poll_result = function (uuid) {
+        if (!self.use_events) {
+            return self.poll_status(uuid);
+        }
+        var source = new EventSource('api/v1.0/status/' + uuid + '/stream');
+        source.onmessage = function (event) {
+            var data = JSON.parse(event.data);
+            if ('message' in data) {
+                bootstrap_alert(data.message);
+            }
+            if (self.update_results(uuid, data)) {
+                source.close();
+            }
+        };
+        source.onerror = function () {
+            // the stream is unavailable or timed out, poll instead
+            source.close();
+            self.poll_status(uuid);
+        };
+    };
+
+    self.poll_status = function (uuid) {
         var url = 'api/v1.0/status/' + uuid;
         net.getJSON(url).then(function (data) {
             if ('message' in data) {
                 bootstrap_alert(data.message);
             }
-            if (data.state == 'pending') {
+            if (!self.update_results(uuid, data)) {
                 setTimeout(function () {
-                    self.poll_result(uuid);
+                    self.poll_status(uuid);
                 }, self.retry_after);
-                return;
             }
-
-            return self.get_results(uuid);
         });
     };
 
+    // show the results for a job status, returns true once the job ended
+    self.update_results = function (uuid, data) {
+        if (data.state == 'pending') {
+            return false;
+        }
+        if (data.state == 'running') {
+            if (!self.partial_results && data.rows > 0) {
+                self.partial_results = true;
+                self.get_results(uuid);
+            }
+            return false;
+        }
+        if (self.partial_results) {
+            self.partial_results = false;
+            self.table.ajax.reload();
+        } else {
+            self.get_results(uuid);
+        }
+        return true;
+    };
+
     self.get_results = function (uuid, more) {
-        var url = '/api/v1.0/result/' + uuid;
+        var url = '/api/v1.0/result/' + uuid + '?limit=1000';
 
         $("#collapseTwo").find("*").prop('disabled', true);
 
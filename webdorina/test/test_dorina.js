@@ -166,12 +166,19 @@ describe('DoRiNAViewModel', function() {
     });
 
     describe('#poll_result', function() {
+        it('should only use status streams the server offers', function() {
+            vm.use_events.should.eql(false);
+            vm = new DoRiNAViewModel(fn, 'fake-uuid', false, true);
+            vm.use_events.should.eql(typeof EventSource !== 'undefined');
+        });
+
         it('should keep polling while state=pending', function(done) {
             fn.expected_url.push('api/v1.0/status/fake-uuid');
             fn.expected_url.push('api/v1.0/status/fake-uuid');
             fn.return_data.push({'state': 'pending'});
             fn.return_data.push({'state': 'done'});
             vm.retry_after = 1;
+            vm.use_events = false;
             vm.get_results = function(uuid) {
                 uuid.should.eql('fake-uuid');
             };
@@ -184,6 +191,27 @@ describe('DoRiNAViewModel', function() {
             }, 2);
 
         });
+
+        it('should show partial results while state=running', function(done) {
+            fn.expected_url.push('api/v1.0/status/fake-uuid');
+            fn.expected_url.push('api/v1.0/status/fake-uuid');
+            fn.return_data.push({'state': 'running', 'rows': 1000});
+            fn.return_data.push({'state': 'done'});
+            vm.retry_after = 1;
+            vm.use_events = false;
+            var reloaded = false;
+            vm.get_results = function(uuid) {
+                uuid.should.eql('fake-uuid');
+                vm.table = {ajax: {reload: function() { reloaded = true; }}};
+            };
+
+            vm.poll_result('fake-uuid');
+            setTimeout(function() {
+                fn.expected_url.should.have.length(0);
+                reloaded.should.be.true;
+                done();
+            }, 2);
+        });
     });
 
     describe('#get_results', function() {
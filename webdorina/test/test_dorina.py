@@ -2,9 +2,19 @@
 # coding=utf-8
 
 from __future__ import unicode_literals
+import builtins
+import functools
+import gzip
+import importlib.util
+import io
 import json
 import os
+import shutil
+import sys
+import tempfile
+import time
 import unittest
+import zlib
 import doctest
 
 import fakeredis
@@ -13,17 +23,53 @@ from minimock import Mock, mock, restore, TraceTracker
 
 import webdorina.workers as run
 import webdorina.app as webdorina
+from webdorina import cleanup, sites, tissues
+from webdorina.genes import GeneIndex
+from webdorina.maintenance import bed, concatenator
+from webdorina.results import FileResultStore, RedisResultStore, \
+    gene_index_key, read_file_blocks, result_key
 from dorina.regulator import Regulator
 
+try:
+    from starlette.testclient import TestClient
+    from webdorina import asgi
+except ImportError:
+    # the ASGI app is optional, see setup.py
+    asgi = None
+
 doctest.testmod(verbose=True, optionflags=doctest.ELLIPSIS)
 
 
+def _load_script(name, filename):
+    """Import a maintenance script whose file name isn't a module name"""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(os.path.dirname(bed.__file__), filename))
+    module = importlib.util.module_from_spec(spec)
+    # pool processes look up the functions they run by module name
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+hubs = _load_script('generate_ucsc_hubs', 'generate-ucsc-hubs.py')
+
+
+def _query_key(**kwargs):
+    """Cache key of the search form defaults with a scifi regulator"""
+    query = dict(genes=['all'], match_a='any', region_a='any', genome='hg19',
+                 set_a=['scifi'], set_b=None, match_b='any', region_b='any',
+                 combine='or', tissue=None)
+    query.update(kwargs)
+    return result_key(query)
+
+
 class RedisStore(object):
 
-    def __init__(self, name, tracker=None):
+    def __init__(self, name, tracker=None, server=None):
         self.name = name
         self.tt = tracker
-        self.connection = fakeredis.FakeRedis(decode_responses=True)
+        self.connection = fakeredis.FakeRedis(server=server,
+                                              decode_responses=True)
 
     def __getattr__(self, attr):
         def wrapped_call(*args, **kwargs):
@@ -38,8 +84,14 @@ class RedisStore(object):
 class RunTestCase(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
-        run.Redis = fakeredis.FakeRedis
-        self.r = fakeredis.FakeStrictRedis(decode_responses=True)
+        # clients of one server share their data, like those of a redis
+        server = fakeredis.FakeServer()
+        run.Redis = functools.partial(fakeredis.FakeRedis, server=server)
+        run._connections.clear()
+        run._stores.clear()
+        self.r = fakeredis.FakeStrictRedis(server=server,
+                                           decode_responses=True)
+        self.store = RedisResultStore(fakeredis.FakeStrictRedis(server=server))
         self.tt = TraceTracker()
         self.return_value = ''
         mock('run.run.Dorina.analyse', tracker=self.tt,
@@ -73,10 +125,10 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
         # TODO restest with mock
         # assert_same_trace(self.tt, expected_trace)
         self.assertTrue(self.r.exists('results:fake_key'))
-        self.assertEqual(2, self.r.llen('results:fake_key'))
+        self.assertEqual(2, self.store.count('results:fake_key'))
         expected = str(self.return_value).split('\n')
         expected.sort(key=lambda x: float(x.split('\t')[13]), reverse=True)
-        self.assertEqual(expected, self.r.lrange('results:fake_key', 0, -1))
+        self.assertEqual(expected, self.store.read('results:fake_key'))
         self.assertTrue(self.r.exists('sessions:fake-uuid'))
         self.assertEqual(json.loads(self.r.get('sessions:fake-uuid')),
                          dict(uuid='fake-uuid', state='done'))
@@ -96,8 +148,8 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
         expected = ['\t\t\t\t\t\t\t\tNo results found']
 
         self.assertTrue(self.r.exists('results:fake_key'))
-        self.assertEqual(1, self.r.llen('results:fake_key'))
-        self.assertEqual(expected, self.r.lrange('results:fake_key', 0, -1))
+        self.assertEqual(1, self.store.count('results:fake_key'))
+        self.assertEqual(expected, self.store.read('results:fake_key'))
 
     def test_run_analyse_custom_regulator(self):
         """Test run_analyze() with a custom regulator"""
@@ -126,8 +178,8 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
         # assert_same_trace(self.tt, expected_trace)
 
         self.assertTrue(self.r.exists('results:fake_key'))
-        self.assertEqual(2, self.r.llen('results:fake_key'))
-        self.assertEqual(expected, self.r.lrange('results:fake_key', 0, -1))
+        self.assertEqual(2, self.store.count('results:fake_key'))
+        self.assertEqual(expected, self.store.read('results:fake_key'))
 
         self.assertTrue(self.r.exists('sessions:fake-uuid'))
         self.assertEqual(json.loads(self.r.get('sessions:fake-uuid')),
@@ -137,6 +189,118 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
         self.assertEqual(json.loads(self.r.get('results:sessions:fake-uuid')),
                          dict(redirect="results:fake_key"))
 
+    def test_analyse_parallel(self):
+        """Test analyse_parallel() merges per regulator results"""
+        rows = dict(
+            scifi=['chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	5	+',
+                   'chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	6	+'],
+            fake01=['chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	550	560	PICTAR#fake*fake_cds	3	+'])
+        restore()
+        mock('run.run.Dorina.analyse', tracker=None,
+             returns_func=lambda **query: '\n'.join(rows[query['set_a'][0]]))
+
+        query = dict(genome='hg19', set_a=['scifi', 'fake01'], match_a='any',
+                     region_a='any', set_b=None)
+        self.assertEqual(rows['scifi'] + rows['fake01'],
+                         run.analyse_parallel(self.data_dir, query, 2))
+
+        query['match_a'] = 'all'
+        self.assertEqual([rows['scifi'][0], rows['fake01'][0]],
+                         run.analyse_parallel(self.data_dir, query, 2))
+
+        query = dict(query, set_a=['scifi'], set_b=['fake01'], match_b='any',
+                     region_b='any', combine='and')
+        self.assertEqual(rows['scifi'][:1],
+                         run.analyse_parallel(self.data_dir, query, 2))
+
+    def test_analyse_parallel_sharded(self):
+        """Test analyse_parallel() runs a query per chromosome shard"""
+        shards = [genes for _, genes in
+                  run.chromosome_genes(self.data_dir, 'hg19')]
+        self.assertEqual([['gene01.01', 'gene01.02']], shards)
+
+        restore()
+        mock('run.run.Dorina.analyse', tracker=None,
+             returns_func=lambda **query: '\n'.join(
+                 'chr1	doRiNA2	gene	1	1000	.	+	.	ID={0}	chr1	250	260	PARCLIP#scifi*scifi_cds	5	+'.format(gene)
+                 for gene in query['genes']))
+        query = dict(genome='hg19', genes=['all'], set_a=['scifi'],
+                     match_a='any', region_a='any', set_b=None)
+        rows = run.analyse_parallel(self.data_dir, query, 2,
+                                    shards=[['gene01.02'], ['gene01.01']])
+        self.assertEqual(['gene01.02', 'gene01.01'],
+                         [run._gene_ids(row)[0] for row in rows])
+
+    def test_run_analyse_streams_regulators(self):
+        """Test run_analyse() stores the rows of each regulator right away"""
+        run._stores['redis', None] = RedisResultStore(self.store.conn,
+                                                      block_size=1)
+        rows = dict(
+            scifi='chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	5	+',
+            fake01='chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	550	560	PICTAR#fake*fake_cds	3	+')
+        seen = []
+
+        def analyse(**query):
+            seen.append((self.store.running('results:fake_key'),
+                         self.store.read('results:fake_key'),
+                         json.loads(self.r.get('sessions:fake-uuid') or
+                                    '{}').get('state')))
+            return rows[query['set_a'][0]]
+
+        restore()
+        mock('run.run.Dorina.analyse', tracker=None, returns_func=analyse)
+        query = dict(genome='hg19', set_a=['scifi', 'fake01'], match_a='any',
+                     region_a='any', set_b=None)
+        run.run_analyse(self.data_dir, 'results:fake_key',
+                        'results:fake_key_pending', query, 'fake-uuid',
+                        SESSION_STORE='/tmp/dorina-{unique_id}',
+                        RESULT_TTL=60, SESSION_TTL=60)
+
+        self.assertEqual(seen, [(True, [], None),
+                                (True, [rows['scifi']], 'running')])
+        self.assertFalse(self.store.running('results:fake_key'))
+        self.assertEqual(self.store.read('results:fake_key'),
+                         [rows['scifi'], rows['fake01']])
+        self.assertEqual(json.loads(self.r.get('sessions:fake-uuid'))['state'],
+                         'done')
+
+    def test_run_analyse_parallel_no_results(self):
+        """Test run_analyse() stores the same empty result on both paths"""
+        query = dict(genome='hg19', set_a=['scifi', 'fake01'], match_a='any',
+                     region_a='any', set_b=None)
+        expected = ['\t\t\t\t\t\t\t\tNo results found']
+        for processes, key in ((1, 'results:single'), (2, 'results:pooled')):
+            run.run_analyse(self.data_dir, key, key + '_pending', dict(query),
+                            'fake-uuid', SESSION_STORE='/tmp/dorina-{unique_id}',
+                            RESULT_TTL=60, SESSION_TTL=60, PROCESSES=processes)
+            self.assertEqual(expected, self.store.read(key))
+
+    def test_group_shards(self):
+        """Test chromosome shards are merged into groups of similar size"""
+        shards = [['a'] * 5, ['b'] * 5, ['c'] * 5, ['d'] * 5]
+        self.assertEqual(run.group_shards(shards, 4), shards)
+        self.assertEqual(run.group_shards(shards, 2),
+                         [['a'] * 5 + ['b'] * 5, ['c'] * 5 + ['d'] * 5])
+        self.assertEqual(run.group_shards(shards, 1), [sum(shards, [])])
+        self.assertEqual(run.group_shards([['a'] * 9, ['b'], ['c']], 2),
+                         [['a'] * 9, ['b', 'c']])
+
+    def test_genome_shards(self):
+        """Test a single shard of all genes is no shard"""
+        query = dict(genome='hg19', genes=['all'], set_a=['scifi'],
+                     match_a='any', region_a='any', set_b=None)
+        self.assertEqual(run.genome_shards(self.data_dir, query),
+                         [['gene01.01', 'gene01.02']])
+        self.assertIsNone(run.genome_shards(self.data_dir, query, 1))
+        self.assertIsNone(run.genome_shards(
+            self.data_dir, dict(query, region_a='intergenic'), 4))
+
+    def test_get_dorina(self):
+        """Test get_dorina() reuses the engine of a data dir"""
+        dorina = run.get_dorina(self.data_dir)
+        self.assertIs(dorina, run.get_dorina(self.data_dir))
+        self.assertIsNot(dorina, run.get_dorina(self.data_dir, 'tissue'))
+
     def test_filter(self):
         """Test filter()"""
 
@@ -146,8 +310,7 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
             'chr1	doRiNA2	gene	3001	4000	.	+	.	ID=gene01.03	chr1	3350	3360	PARCLIP#scifi*scifi_intron	7	+'
         ]
 
-        for d in data:
-            self.r.rpush('results:fake_full_key', d)
+        self.store.write('results:fake_full_key', data, 60)
 
         run.filter(['gene01.01', 'gene01.02'], 'results:fake_full_key',
                    'results:fake_key', 'results:fake_key_pending', 'fake-uuid')
@@ -155,11 +318,660 @@ chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scif
         data.pop()
 
         self.assertTrue(self.r.exists('results:fake_key'))
-        self.assertEqual(2, self.r.llen('results:fake_key'))
-        self.assertEqual(data, self.r.lrange('results:fake_key', 0, -1))
+        self.assertEqual(2, self.store.count('results:fake_key'))
+        self.assertEqual(data, self.store.read('results:fake_key'))
 
         self.assertTrue(self.r.exists('results:sessions:fake-uuid'))
 
+    def test_run_analyse_indexes_genes(self):
+        """Test run_analyze() indexes the rows of an all genes query"""
+        query = dict(genome='hg19', set_a=['scifi'], match_a='any',
+                     region_a='any', set_b=None, genes=['all'])
+        self.return_value = u"""chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	5	+
+chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	6	+
+chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	550	560	PARCLIP#scifi*scifi_cds	7	+"""
+
+        run.run_analyse(self.data_dir, 'results:fake_key',
+                        'results:fake_key_pending', query, 'fake-uuid',
+                        SESSION_STORE='/tmp/dorina-{unique_id}',
+                        RESULT_TTL=60, SESSION_TTL=60)
+
+        self.assertEqual(self.r.hgetall(run.gene_index_key('results:fake_key')),
+                         {'gene01.01': '0,2', 'gene01.02': '1'})
+
+    def test_filter_genes_indexed(self):
+        """Test filter_genes() using the gene index"""
+        data = [
+            'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+',
+            'chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	5	+',
+            'chr1	doRiNA2	gene	3001	4000	.	+	.	ID=gene01.03	chr1	3350	3360	PARCLIP#scifi*scifi_intron	7	+'
+        ]
+        self.store.write('results:fake_full_key', data, 60,
+                         run.gene_offsets(data))
+
+        run.filter_genes(['gene01.03', 'gene01.01'], 'results:fake_full_key',
+                         'results:fake_key', 'results:fake_key_pending',
+                         'fake-uuid', session_ttl=60, result_ttl=60)
+
+        self.assertEqual([data[0], data[2]],
+                         self.store.read('results:fake_key'))
+
+    def test_combine_results_failed(self):
+        """Test combine_results() reports a lost result as an error"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = run._result_store('disk', path)
+        store.write('results:fake_key_a', ['row_a'], 60)
+        store.write('results:fake_key_b', ['row_b'], 60)
+        for filename in store.files_for('results:fake_key_b'):
+            os.remove(filename)
+        self.r.set('results:fake_key_pending', 'fake-uuid')
+
+        run.combine_results('or', 'results:fake_key_a', 'results:fake_key_b',
+                            'results:fake_key', 'results:fake_key_pending',
+                            'fake-uuid', session_ttl=60, result_ttl=60,
+                            result_backend='disk', result_path=path)
+
+        self.assertFalse(self.r.exists('results:fake_key_pending'))
+        self.assertEqual(json.loads(self.r.get('sessions:fake-uuid')),
+                         dict(state='error', uuid='fake-uuid'))
+        self.assertIn('Job failed', store.read('results:fake_key')[0])
+
+    def test_finish_job_notifies_waiters(self):
+        """Test finish_job() points every waiting session at the result"""
+        self.r.set('results:fake_key_pending', 'fake-uuid')
+        self.r.sadd('results:fake_key_pending_waiters', 'fake-uuid',
+                    'other-uuid')
+
+        run.finish_job(run._redis(), 'results:fake_key',
+                       'results:fake_key_pending', 'fake-uuid', 'done', 60)
+
+        self.assertFalse(self.r.exists('results:fake_key_pending'))
+        self.assertFalse(self.r.exists('results:fake_key_pending_waiters'))
+        for uuid in ('fake-uuid', 'other-uuid'):
+            self.assertEqual(
+                json.loads(self.r.get('results:sessions:' + uuid)),
+                dict(redirect='results:fake_key'))
+            self.assertEqual(json.loads(self.r.get('sessions:' + uuid)),
+                             dict(state='done', uuid=uuid))
+
+    def test_combine_results(self):
+        """Test combine_results() on cached set A and set B results"""
+        rows_a = [
+            'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+',
+            'chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	5	+'
+        ]
+        rows_b = [
+            'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	550	560	PICTAR#fake*fake_cds	3	+',
+            'chr1	doRiNA2	gene	3001	4000	.	+	.	ID=gene01.03	chr1	3350	3360	PICTAR#fake*fake_cds	7	+'
+        ]
+        self.store.write('results:fake_key_a', rows_a, 60)
+        self.store.write('results:fake_key_b', rows_b, 60)
+
+        expected = {'or': rows_a + rows_b, 'and': rows_a[:1],
+                    'not': rows_a[1:], 'xor': [rows_a[1], rows_b[1]]}
+        for combine, rows in expected.items():
+            run.combine_results(combine, 'results:fake_key_a',
+                                'results:fake_key_b', 'results:fake_key',
+                                'results:fake_key_pending', 'fake-uuid',
+                                session_ttl=60, result_ttl=60)
+            self.assertEqual(rows, self.store.read('results:fake_key'))
+            self.assertFalse(
+                self.r.exists(run.gene_index_key('results:fake_key')))
+
+        self.assertEqual(json.loads(self.r.get('results:sessions:fake-uuid')),
+                         dict(redirect="results:fake_key"))
+
+        run.combine_results('or', 'results:fake_key_a', 'results:fake_key_b',
+                            'results:fake_key', 'results:fake_key_pending',
+                            'fake-uuid', session_ttl=60, result_ttl=60,
+                            genome_wide=True)
+        self.assertEqual(self.r.hgetall(run.gene_index_key('results:fake_key')),
+                         {'gene01.01': '0,2', 'gene01.02': '1',
+                          'gene01.03': '3'})
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis()
+        self.store = RedisResultStore(self.r, block_size=3)
+        self.rows = ['row{0}'.format(i) for i in range(10)]
+        self.store.write('results:fake_key', self.rows, 60)
+
+    def tearDown(self):
+        self.r.flushdb()
+
+    def test_write(self):
+        """Test ResultStore.write() packs rows into blocks"""
+        self.assertEqual(self.store.count('results:fake_key'), 10)
+        # header plus four blocks
+        self.assertEqual(self.r.hlen('results:fake_key'), 6)
+        self.assertGreater(self.r.ttl('results:fake_key'), 0)
+
+    def test_read(self):
+        """Test ResultStore.read() and rows() across block boundaries"""
+        self.assertEqual(self.store.read('results:fake_key'), self.rows)
+        self.assertEqual(self.store.read('results:fake_key', 2, 7),
+                         self.rows[2:7])
+        self.assertEqual(self.store.read('results:fake_key', 8, 100),
+                         self.rows[8:])
+        self.assertEqual(self.store.rows('results:fake_key', [0, 4, 9]),
+                         ['row0', 'row4', 'row9'])
+        self.assertEqual(self.store.read('results:missing'), [])
+
+    def test_result_key(self):
+        """Test result_key() is shared by equivalent queries"""
+        self.assertEqual(_query_key(set_a=['scifi', 'fake01']),
+                         _query_key(set_a=['fake01', 'scifi', 'fake01']))
+        self.assertEqual(_query_key(genes=['b', 'a']),
+                         _query_key(genes=['a', 'b']))
+        self.assertEqual(_query_key(match_a='all'), _query_key())
+        self.assertEqual(_query_key(combine='and'), _query_key())
+        self.assertNotEqual(_query_key(set_a=['scifi', 'fake01']),
+                            _query_key(set_a=['scifi', 'fake01'],
+                                       match_a='all'))
+        self.assertNotEqual(_query_key(set_b=['fake01'], combine='and'),
+                            _query_key(set_b=['fake01']))
+        self.assertEqual(len(_query_key()), len('results:') + 40)
+
+    def test_writer(self):
+        """Test ResultWriter makes complete blocks readable right away"""
+        writer = self.store.writer('results:fake_key', 60)
+        self.assertTrue(self.store.running('results:fake_key'))
+        self.assertFalse(self.store.complete('results:fake_key'))
+
+        self.assertEqual(writer.append(self.rows[:4]), 3)
+        self.assertEqual(self.store.read('results:fake_key'), self.rows[:3])
+        writer.append(self.rows[4:])
+        self.assertEqual(writer.close(), 10)
+
+        self.assertTrue(self.store.complete('results:fake_key'))
+        self.assertEqual(self.store.read('results:fake_key'), self.rows)
+
+    def test_gene_index(self):
+        """Test every write replaces the gene index of the result"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        index_key = gene_index_key('results:fake_key')
+        for store in (self.store, FileResultStore(self.r, path, block_size=3)):
+            store.write('results:fake_key', self.rows, 60, {'gene01': '0,4'})
+            self.assertEqual(self.r.hgetall(index_key), {b'gene01': b'0,4'})
+            self.assertGreater(self.r.ttl(index_key), 0)
+
+            writer = store.writer('results:fake_key', 60)
+            self.assertFalse(self.r.exists(index_key))
+            writer.append(self.rows)
+            writer.close({'gene02': '1'})
+            self.assertEqual(self.r.hgetall(index_key), {b'gene02': b'1'})
+
+            store.write('results:fake_key', self.rows, 60)
+            self.assertFalse(self.r.exists(index_key))
+
+    def test_file_store(self):
+        """Test FileResultStore keeps only the header in Redis"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = FileResultStore(self.r, path, block_size=3)
+        store.write('results:file_key', self.rows, 60)
+
+        self.assertEqual(store.count('results:file_key'), 10)
+        self.assertEqual(sorted(self.r.hkeys('results:file_key')),
+                         [b'block_size', b'path', b'rows'])
+        first = os.fsdecode(self.r.hget('results:file_key', 'path'))
+        self.assertEqual(store.files_for('results:file_key'), [first])
+        self.assertEqual(store.read('results:file_key', 2, 7), self.rows[2:7])
+        self.assertEqual(store.rows('results:file_key', [1, 9]),
+                         ['row1', 'row9'])
+
+        writer = store.writer('results:file_key', 60)
+        writer.append(self.rows[:5])
+        self.assertEqual(store.read('results:file_key'), self.rows[:3])
+        writer.close()
+        self.assertEqual(store.read('results:file_key'), self.rows[:5])
+        self.assertEqual(sorted(self.r.hkeys('results:file_key')),
+                         [b'block_size', b'path', b'rows'])
+
+        # readers holding the old header still read the old result
+        self.assertEqual(read_file_blocks(first, [3]),
+                         [zlib.compress(b'row9')])
+        current = os.fsdecode(self.r.hget('results:file_key', 'path'))
+        self.assertEqual(sorted(store.files_for('results:file_key')),
+                         sorted([first, current]))
+        size = os.path.getsize(first)
+        self.assertEqual(list(store.purge(min_age=0)), [(first, size)])
+
+        self.r.delete('results:file_key')
+        size = os.path.getsize(current)
+        self.assertEqual(list(store.purge(min_age=0)), [(current, size)])
+
+
+@unittest.skipIf(sites.np is None, 'site indexes need numpy')
+class SitesTestCase(unittest.TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.bed_path = os.path.join(path, 'PARCLIP_scifi.bed')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'data',
+                                 'regulators', 'h_sapiens', 'hg19',
+                                 'PARCLIP_scifi.bed'), self.bed_path)
+
+    def test_index(self):
+        """Test the site index counts overlapping sites"""
+        self.assertIsNone(sites.load(self.bed_path))
+        sites.build_index(self.bed_path)
+        self.assertTrue(sites.up_to_date(self.bed_path))
+
+        index = sites.load(self.bed_path)
+        self.assertIs(index, sites.load(self.bed_path))
+        self.assertEqual(index.chromosomes(), {'chr1'})
+        self.assertEqual(list(index.count('chr1', [1, 300, 1255],
+                                          [1000, 1200, 1258])), [1, 0, 1])
+        self.assertEqual(list(index.count('chr2', [1], [1000])), [0])
+
+
+class BedTestCase(unittest.TestCase):
+    def test_convert(self):
+        """Test BED12 blocks are split into BED6 records"""
+        lines = ['track name=test\n',
+                 'chr1\t250\t260\tscifi_cds\t5\t+\t250\t260\n',
+                 'chr2\t100\t500\tsplit\t7\t-\t100\t500\t0\t3\t'
+                 '10,20,30,\t0,100,370,\n']
+        expected = ['chr1\t250\t260\tscifi_cds\t5\t+\n',
+                    'chr2\t100\t110\tsplit\t7\t-\n',
+                    'chr2\t200\t220\tsplit\t7\t-\n',
+                    'chr2\t470\t500\tsplit\t7\t-\n']
+        out = io.StringIO()
+        self.assertEqual(bed.convert(lines, out, batch_size=1), 2)
+        self.assertEqual(out.getvalue(), ''.join(expected))
+
+    def test_sort_lines(self):
+        """Test BED lines are sorted in merged runs"""
+        lines = ['chr2\t5\t6\n', 'chr1\t20\t21\n', 'chr1\t3\t4\n',
+                 'chr10\t1\t2\n', 'chr1\t100\t101\n']
+        expected = ['chr1\t3\t4\n', 'chr1\t20\t21\n', 'chr1\t100\t101\n',
+                    'chr10\t1\t2\n', 'chr2\t5\t6\n']
+        for buffer_size in (2, 10):
+            out = io.StringIO()
+            bed.sort_lines(iter(lines), out, buffer_size)
+            self.assertEqual(out.getvalue(), ''.join(expected))
+
+
+class ConcatenatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.regulators_path = os.path.join(self.path, 'regulators')
+        shutil.copytree(
+            os.path.join(os.path.dirname(__file__), 'data', 'regulators'),
+            self.regulators_path)
+
+    def concatenate(self):
+        return [concatenator.concatenate(*task) for task in
+                concatenator.walk_tree(self.regulators_path)]
+
+    def test_concatenate_up_to_date(self):
+        """Test a second run skips experiments whose inputs didn't change"""
+        basename = os.path.join(self.regulators_path, 'h_sapiens', 'hg19',
+                                'PARCLIP_hg19_all')
+        self.assertEqual(self.concatenate(), [basename])
+        mtimes = [os.path.getmtime(basename + ext)
+                  for ext in ('.bed', '.json')]
+
+        self.assertEqual(self.concatenate(), [None])
+        # touched, but unchanged inputs
+        os.utime(os.path.join(self.regulators_path, 'h_sapiens', 'hg19',
+                              'PARCLIP_scifi.bed'))
+        self.assertEqual(self.concatenate(), [None])
+        self.assertEqual(mtimes, [os.path.getmtime(basename + ext)
+                                  for ext in ('.bed', '.json')])
+
+        with open(os.path.join(self.regulators_path, 'h_sapiens', 'hg19',
+                               'PARCLIP_scifi.bed'), 'a') as fh:
+            fh.write('chr1\t3350\t3360\tPARCLIP#scifi*scifi_cds\t5\t+\n')
+        self.assertEqual(self.concatenate(), [basename])
+
+
+    def test_concatenate_unwritable(self):
+        """Test the error of a BED file that can't be written is raised"""
+        def open_(filename, *args, **kwargs):
+            if filename.endswith('.bed.tmp'):
+                raise PermissionError(filename)
+            return builtins.open(filename, *args, **kwargs)
+
+        concatenator.open = open_
+        self.addCleanup(delattr, concatenator, 'open')
+        self.assertRaises(PermissionError, self.concatenate)
+
+
+class HubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.data_path = os.path.join(self.path, 'data')
+        self.hub_path = os.path.join(self.path, 'hub')
+        self.tmp_dir = os.path.join(self.path, 'tmp')
+        os.mkdir(self.tmp_dir)
+        shutil.copytree(
+            os.path.join(os.path.dirname(__file__), 'data', 'regulators'),
+            os.path.join(self.data_path, 'regulators'))
+        genome_path = os.path.join(self.data_path, 'genomes', 'h_sapiens',
+                                   'hg19')
+        os.makedirs(genome_path)
+        with open(os.path.join(genome_path, 'hg19.genome'), 'w') as fh:
+            fh.write('chr1\t249250621\n')
+        # stands in for bedToBigBed, logs its calls and copies the sorted
+        # BED file
+        self.calls = os.path.join(self.path, 'calls')
+        self.bed_to_big_bed = os.path.join(self.path, 'bedToBigBed')
+        with open(self.bed_to_big_bed, 'w') as fh:
+            fh.write('#!/bin/sh\necho "$3" >> "{}"\ncp "$1" "$3"\n'.format(
+                self.calls))
+        os.chmod(self.bed_to_big_bed, 0o755)
+
+    def build_hub(self):
+        return hubs.build_hub(self.data_path, self.hub_path, 1,
+                              bed_to_big_bed=self.bed_to_big_bed,
+                              tmp_dir=self.tmp_dir)
+
+    def _conversions(self):
+        if not os.path.exists(self.calls):
+            return 0
+        with open(self.calls) as fh:
+            return len(fh.readlines())
+
+    def test_build_hub_up_to_date(self):
+        """Test a second build doesn't convert up to date regulators"""
+        manifest = self.build_hub()
+        self.assertEqual(self._conversions(), 2)
+        hub_dir = os.path.join(self.hub_path, 'h_sapiens', 'hg19')
+        bb_paths = [os.path.join(hub_dir, name + '.bb')
+                    for name in ('PARCLIP_scifi', 'PICTAR_fake')]
+        mtimes = [os.path.getmtime(bb_path) for bb_path in bb_paths]
+
+        self.assertEqual(self.build_hub(), manifest)
+        self.assertEqual(self._conversions(), 2)
+        self.assertEqual(mtimes, [os.path.getmtime(bb_path)
+                                  for bb_path in bb_paths])
+
+        # a changed BED file only converts its own regulator
+        bed_path = os.path.join(self.data_path, 'regulators', 'h_sapiens',
+                                'hg19', 'PICTAR_fake.bed')
+        os.utime(bed_path, (mtimes[1] + 10, mtimes[1] + 10))
+        self.build_hub()
+        self.assertEqual(self._conversions(), 3)
+        self.assertEqual(mtimes[0], os.path.getmtime(bb_paths[0]))
+
+    def test_build_hub_malformed_lines(self):
+        """Test lines without numeric coordinates are left out"""
+        bed_path = os.path.join(self.data_path, 'regulators', 'h_sapiens',
+                                'hg19', 'PICTAR_fake.bed')
+        with open(bed_path) as fh:
+            sites = len(fh.readlines())
+        with open(bed_path, 'a') as fh:
+            fh.write('chr1\tstart\t300\tPICTAR#fake01*broken\t5\t+\n')
+
+        manifest = self.build_hub()
+        self.assertEqual([track['track'] for track in manifest[0]['tracks']],
+                         ['PARCLIP_scifi', 'PICTAR_fake'])
+        with open(os.path.join(self.hub_path, 'h_sapiens', 'hg19',
+                               'PICTAR_fake.bb')) as fh:
+            self.assertEqual(len(fh.readlines()), sites)
+
+    def test_build_hub_failed_track(self):
+        """Test a regulator that can't be converted is left out of the hub"""
+        with open(os.path.join(self.data_path, 'regulators', 'h_sapiens',
+                               'hg19', 'PICTAR_fake.bed'), 'ab') as fh:
+            fh.write(b'chr1\t300\t310\tPICTAR#fake01*\xff\t5\t+\n')
+
+        manifest = self.build_hub()
+        self.assertEqual([track['track'] for track in manifest[0]['tracks']],
+                         ['PARCLIP_scifi'])
+        with open(os.path.join(self.hub_path, 'manifest.json')) as fh:
+            self.assertEqual(json.load(fh), manifest)
+        hub_dir = os.path.join(self.hub_path, 'h_sapiens', 'hg19')
+        self.assertTrue(os.path.exists(
+            os.path.join(hub_dir, 'PARCLIP_scifi.bb')))
+        self.assertFalse(os.path.exists(
+            os.path.join(hub_dir, 'PICTAR_fake.bb')))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class CleanupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.r = fakeredis.FakeRedis(decode_responses=True)
+        self.r.flushall()
+        config = cleanup.load_config()
+        config.update(SESSION_STORE=os.path.join(self.path,
+                                                 'dorina-{unique_id}'),
+                      CLEANUP_MIN_AGE=0)
+        self.cleanup = cleanup.Cleanup(self.r, config)
+        self.addCleanup(self.cleanup.pool.shutdown)
+
+    def _session_dir(self, unique_id):
+        dirname = os.path.join(self.path, 'dorina-{}'.format(unique_id))
+        os.mkdir(dirname)
+        with open(os.path.join(dirname, 'regulator.bed'), 'w') as fh:
+            fh.write('chr1\t1\t2\n')
+        return dirname
+
+    def test_expired(self):
+        """Test expiry events remove session directories in the pool"""
+        dirname = self._session_dir('cc5f8d3a-3b8d-4c25-9d9b-7a8a4ad3e1f0')
+        self.cleanup.expired(dict(
+            data=b'sessions:cc5f8d3a-3b8d-4c25-9d9b-7a8a4ad3e1f0'))
+        self.cleanup.expired(dict(data='sessions:../../etc'))
+        self.cleanup.pool.shutdown()
+        self.assertFalse(os.path.exists(dirname))
+        metrics = self.r.hgetall(cleanup.METRICS_KEY)
+        self.assertEqual(metrics['dirs_removed'], '1')
+        self.assertEqual(metrics['bytes_freed'], '9')
+        self.assertEqual(metrics['queued'], '0')
+
+    def test_expired_result_rewritten(self):
+        """Test expiry events keep the files of keys written again"""
+        self.cleanup.results = FileResultStore(fakeredis.FakeRedis(),
+                                               self.path)
+        filename = self.cleanup.results._write_file('results:fake_key',
+                                                    [b'block'])
+
+        self.r.hset('results:fake_key', 'path', filename)
+        self.cleanup._expired('results:fake_key', time.time())
+        self.assertTrue(os.path.exists(filename))
+
+        self.r.delete('results:fake_key')
+        # rewritten, but its header isn't set yet
+        self.cleanup.min_age = 60
+        self.cleanup._expired('results:fake_key', time.time())
+        self.assertTrue(os.path.exists(filename))
+
+        self.cleanup.min_age = 0
+        self.cleanup._expired('results:fake_key', time.time())
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(self.r.hget(cleanup.METRICS_KEY, 'files_removed'),
+                         '1')
+
+    def test_sweep(self):
+        """Test sweeps remove session directories without a session"""
+        live = self._session_dir('1b4e28ba-2fa1-11d2-883f-0016d3cca427')
+        self.r.set('sessions:1b4e28ba-2fa1-11d2-883f-0016d3cca427', '{}')
+        orphan = self._session_dir('6fa459ea-ee8a-3ca4-894e-db77e160355e')
+        other = os.path.join(self.path, 'dorina-results')
+        os.mkdir(other)
+
+        self.assertEqual(self.cleanup.sweep(), 1)
+        self.assertTrue(os.path.exists(live))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(self.r.hget(cleanup.METRICS_KEY, 'swept'), '1')
+
+
+class TissuesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_path)
+        self.genes_p_tissue = dict(liver=['gene01.01', 'gene01.02'],
+                                   brain=['gene01.03'])
+        with open(os.path.join(self.data_path, 'hg19_tissues.json'),
+                  'w') as open_f:
+            json.dump(self.genes_p_tissue, open_f)
+
+    def test_json(self):
+        """Test tissue lookups in the JSON map"""
+        self.assertEqual(sorted(tissues.names(self.data_path, 'hg19')),
+                         ['brain', 'liver'])
+        self.assertEqual(tissues.genes(self.data_path, 'hg19', 'liver'),
+                         ['gene01.01', 'gene01.02'])
+        self.assertIsNone(tissues.genes(self.data_path, 'hg19', 'invalid'))
+
+    def test_sqlite_index(self):
+        """Test tissue lookups in the sqlite index"""
+        index_path = tissues.build_index(self.data_path, 'hg19')
+        self.assertTrue(os.path.exists(index_path))
+        self.assertEqual(sorted(tissues.names(self.data_path, 'hg19')),
+                         ['brain', 'liver'])
+        self.assertEqual(tissues.genes(self.data_path, 'hg19', 'brain'),
+                         ['gene01.03'])
+        self.assertIsNone(tissues.genes(self.data_path, 'hg19', 'invalid'))
+
+    def test_sqlite_index_cached(self):
+        """Test tissues looked up in the index are kept until it changes"""
+        index_path = tissues.build_index(self.data_path, 'hg19')
+        self.assertEqual(tissues.genes(self.data_path, 'hg19', 'brain'),
+                         ['gene01.03'])
+        mock('tissues.sqlite3.connect', tracker=None,
+             raises=AssertionError('index read again'))
+        self.addCleanup(restore)
+        self.assertEqual(tissues.genes(self.data_path, 'hg19', 'brain'),
+                         ['gene01.03'])
+        restore()
+
+        self.genes_p_tissue['brain'].append('gene01.04')
+        with open(os.path.join(self.data_path, 'hg19_tissues.json'),
+                  'w') as open_f:
+            json.dump(self.genes_p_tissue, open_f)
+        tissues.build_index(self.data_path, 'hg19')
+        mtime = os.path.getmtime(index_path) + 10
+        os.utime(index_path, (mtime, mtime))
+        self.assertEqual(tissues.genes(self.data_path, 'hg19', 'brain'),
+                         ['gene01.03', 'gene01.04'])
+
+
+@unittest.skipIf(asgi is None, 'the ASGI app needs starlette and asgiref')
+class AsgiTestCase(unittest.TestCase):
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.r = fakeredis.FakeRedis(server=server, decode_responses=True)
+        self.store = RedisResultStore(fakeredis.FakeRedis(server=server))
+        conn, blocks_conn = asgi.conn, asgi.blocks_conn
+        asgi.conn = fakeredis.FakeAsyncRedis(server=server,
+                                             decode_responses=True)
+        asgi.blocks_conn = fakeredis.FakeAsyncRedis(server=server)
+        self.addCleanup(setattr, asgi, 'conn', conn)
+        self.addCleanup(setattr, asgi, 'blocks_conn', blocks_conn)
+        # one event loop for all requests, like a server
+        self.client = TestClient(asgi.application)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+
+    def _session(self, key, state='done'):
+        self.r.set('sessions:fake-uuid',
+                   json.dumps(dict(uuid='fake-uuid', state=state)))
+        self.r.set('results:sessions:fake-uuid',
+                   json.dumps(dict(redirect=key)))
+
+    def test_status(self):
+        """Test the session status and its stream"""
+        rv = self.client.get('/api/v1.0/status/fake-uuid')
+        self.assertEqual(rv.json(), dict(uuid='fake-uuid', state='expired'))
+
+        self._session('results:fake_key')
+        rv = self.client.get('/api/v1.0/status/fake-uuid')
+        self.assertEqual(rv.json()['state'], 'done')
+
+        rv = self.client.get('/api/v1.0/status/fake-uuid/stream')
+        self.assertEqual(rv.headers['content-type'],
+                         'text/event-stream; charset=utf-8')
+        event = json.loads(rv.text[len('data: '):])
+        self.assertEqual(event['state'], 'done')
+
+    def test_get_result_paginated(self):
+        """Test result pages are read from the blocks of the page"""
+        results = ['row{0:03d}'.format(i) for i in range(250)]
+        self.store.write('results:fake_key', results, 60)
+        self._session('results:fake_key')
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid?offset=200&limit=20')
+        self.assertEqual(rv.json(), webdorina._result_page(
+            results[200:220], 200, 20, 250))
+        self.assertTrue(rv.json()['more_results'])
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid/240')
+        self.assertEqual(rv.json()['results'], results[240:])
+        self.assertFalse(rv.json()['more_results'])
+
+        rv = self.client.get('/api/v1.0/result/other-uuid')
+        self.assertEqual(rv.json(), dict(uuid='other-uuid', state='expired'))
+
+    def test_get_result_running(self):
+        """Test the rows of a running analysis are served"""
+        results = ['row{0:04d}'.format(i) for i in range(1500)]
+        writer = self.store.writer('results:fake_key', 60)
+        writer.append(results)
+        self._session('results:fake_key', 'running')
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid')
+        self.assertEqual(rv.json()['state'], 'running')
+        self.assertEqual(rv.json()['results'], results[:100])
+        self.assertEqual(rv.json()['total_results'], 1000)
+        self.assertTrue(rv.json()['more_results'])
+
+        writer.close()
+        rv = self.client.get('/api/v1.0/result/fake-uuid?offset=1400')
+        self.assertEqual(rv.json()['state'], 'done')
+        self.assertEqual(rv.json()['results'], results[1400:])
+
+    def test_get_result_error(self):
+        """Test a failed job is reported as an error"""
+        self.store.write('results:fake_key', ['Job failed: broken'], 60)
+        self._session('results:fake_key', 'error')
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid')
+        self.assertEqual(rv.json(), dict(state='error', results=[],
+                                         message='Job failed: broken',
+                                         total_results=0))
+
+    def test_download_results(self):
+        """Test downloads stream the whole result, gzipped on request"""
+        results = ['row{0:04d}'.format(i) for i in range(2500)]
+        self.store.write('results:fake_key', results, 60)
+        self._session('results:fake_key')
+        expected = ''.join(row + '\n' for row in results)
+
+        rv = self.client.get('/api/v1.0/download/results/fake-uuid')
+        self.assertEqual(rv.text, expected)
+        self.assertEqual(rv.headers['content-disposition'],
+                         'attachment; filename=carina_fake-uuid.txt')
+
+        # read the raw body, the client would undo the compression
+        with self.client.stream(
+                'GET', '/api/v1.0/download/results/fake-uuid?compress=gzip',
+                headers={'Accept-Encoding': 'identity'}) as rv:
+            body = b''.join(rv.iter_raw())
+        self.assertEqual(rv.headers['content-type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(body).decode('utf-8'), expected)
+
+        rv = self.client.get('/api/v1.0/download/results/other-uuid')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_flask_routes(self):
+        """Test other routes fall through to the Flask app"""
+        rv = self.client.get('/api/v1.0/genomes')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json(), json.loads(
+            webdorina.catalogue['api_genomes'][0]))
+
 
 class DorinaTestCase(TestCase):
     def create_app(self):
@@ -170,8 +982,12 @@ class DorinaTestCase(TestCase):
         self.maxDiff = None
         self.tt = TraceTracker()
         webdorina.datadir = os.path.join(os.path.dirname(__file__), 'data')
-        webdorina.conn = RedisStore('fake_store', self.tt)
+        server = fakeredis.FakeServer()
+        webdorina.conn = RedisStore('fake_store', self.tt, server)
         self.r = webdorina.conn.connection
+        webdorina.raw_conn = fakeredis.FakeRedis(server=server)
+        self.store = RedisResultStore(webdorina.raw_conn)
+        webdorina.store = self.store
         fake_queue = Mock('webdorina.Queue', tracker=self.tt)
         mock('webdorina.Queue', tracker=self.tt, returns=fake_queue)
         # use tracker=None to not track uuid4() calls
@@ -186,6 +1002,21 @@ class DorinaTestCase(TestCase):
         rv = self.client.get('/')
         assert b"doRiNA" in rv.data
 
+    def test_search_page_polls(self):
+        """Test the search page only uses status streams when served so"""
+        # importing webdorina.asgi turns them on
+        self.addCleanup(self.app.config.__setitem__, 'STATUS_STREAMS',
+                        self.app.config['STATUS_STREAMS'])
+        self.app.config['STATUS_STREAMS'] = False
+        rv = self.client.get('/search')
+        self.assertRegex(rv.data.decode('utf8'),
+                         r"DoRiNAViewModel\(net, 'fake-uuid', false,\s+false\)")
+
+        self.app.config['STATUS_STREAMS'] = True
+        rv = self.client.get('/search')
+        self.assertRegex(rv.data.decode('utf8'),
+                         r"DoRiNAViewModel\(net, 'fake-uuid', false,\s+true\)")
+
     def test_list_regulators(self):
         """Test list_regulators()"""
         all_regulators = Regulator.all()
@@ -204,9 +1035,7 @@ class DorinaTestCase(TestCase):
                    json.dumps(dict(uuid='fake-uuid', state='done')))
         data = dict(match_a='any', assembly='hg19', uuid='fake-uuid')
         data['set_a[]'] = ['scifi']
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key()
         key_pending = '{0}_pending'.format(key)
 
         rv = self.client.post('/api/v1.0/search', data=data)
@@ -259,11 +1088,9 @@ Called webdorina.Queue.enqueue(
         """Test search() with a query for this key pending"""
         self.r.set('sessions:fake-uuid',
                    json.dumps(dict(uuid='fake-uuid', state='done')))
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key()
         key_pending = '{0}_pending'.format(key)
-        self.r.set(key_pending, True)
+        self.r.set(key_pending, 'other-uuid')
 
         data = dict(match_a='any', assembly='hg19', uuid='fake-uuid')
         data['set_a[]'] = ['scifi']
@@ -287,16 +1114,13 @@ Called fake_store.get(
 
     def test_search_cached_results(self):
         """Test search() with cached_results"""
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key()
         results = [
             'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+	250	260',
             'chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	5	+	2350	2360',
             'chr1	doRiNA2	gene	3001	4000	.	+	.	ID=gene01.03	chr1	3350	3360	PARCLIP#scifi*scifi_intron	7	+	3350	3360'
         ]
-        for res in results:
-            self.r.rpush(key, res)
+        self.store.write(key, results, 60)
 
         self.r.set('sessions:fake-uuid',
                    json.dumps(dict(state='done', uuid='fake-uuid')))
@@ -352,9 +1176,7 @@ Called fake_store.llen(
         data = dict(match_a='all', assembly='hg19', uuid='fake-uuid')
         data['set_a[]'] = ['scifi', 'fake01']
         rv = self.client.post('/api/v1.0/search', data=data)
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "all", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi", "fake01"], "set_b": null}'
+        key = _query_key(match_a='all', set_a=['scifi', 'fake01'])
         key_pending = '{0}_pending'.format(key)
 
         # Now a query should be pending
@@ -405,9 +1227,7 @@ Called webdorina.Queue.enqueue(
         data = dict(match_a='any', region_a='CDS', assembly='hg19',
                     uuid='fake-uuid')
         data['set_a[]'] = ['scifi', 'fake01']
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "CDS", '
-        key += '"region_b": "any", "set_a": ["scifi", "fake01"], "set_b": null}'
+        key = _query_key(region_a='CDS', set_a=['scifi', 'fake01'])
         key_pending = '{0}_pending'.format(key)
 
         rv = self.client.post('/api/v1.0/search', data=data)
@@ -457,14 +1277,11 @@ Called webdorina.Queue.enqueue( # doctest:+ELLIPSIS
 
     def test_search_filtered_results_cached(self):
         """Test search() with filtered results in cache"""
-        key = 'results:{"combine": "or", "genes": ["fake01"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key(genes=['fake01'])
         results = [
             'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+'
         ]
-        for res in results:
-            self.r.rpush(key, res)
+        self.store.write(key, results, 60)
 
         self.r.set('sessions:fake-uuid',
                    json.dumps(dict(uuid='fake-uuid', state='done')))
@@ -514,18 +1331,14 @@ Called fake_store.llen(
 
     def test_search_filtered_full_results_cached(self):
         """Test search() with filter and full results in cache"""
-        templ = 'results:{{"combine": "or", "genes": ["{0}"], "genome": "hg19", '
-        templ += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        templ += '"region_b": "any", "set_a": ["scifi"], "set_b": null}}'
-        full_key = templ.format('all')
-        key = templ.format('fake01')
+        full_key = _query_key()
+        key = _query_key(genes=['fake01'])
         key_pending = '{0}_pending'.format(key)
         results = [
             'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+',
             'chr1	doRiNA2	gene	2001	3000	.	+	.	ID=gene01.02	chr1	2350	2360	PARCLIP#scifi*scifi_intron	5	+'
         ]
-        for res in results:
-            self.r.rpush(full_key, res)
+        self.store.write(full_key, results, 60)
 
         self.r.set('sessions:fake-uuid',
                    json.dumps(dict(uuid='fake-uuid', state='done')))
@@ -543,8 +1356,7 @@ Called fake_store.llen(
         # now pretend the filtering finished
         results.pop()
         self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
-        for res in results:
-            self.r.rpush(key, res)
+        self.store.write(key, results, 60)
 
         rv = self.client.get('/api/v1.0/result/fake-uuid')
         expected = dict(state='done', results=results, more_results=False,
@@ -597,9 +1409,7 @@ Called fake_store.llen(
 
     def test_search_filtered_results_nothing_cached(self):
         '''Test search() with filtered results without anything in cache'''
-        full_key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        full_key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        full_key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        full_key = _query_key()
 
         self.r.set('sessions:fake-uuid',
                    json.dumps(dict(uuid='fake-uuid', state='pending')))
@@ -612,14 +1422,11 @@ Called fake_store.llen(
         self.assertEqual(rv.json, dict(state='pending', uuid="fake-uuid"))
 
         # now pretend the search finished
-        key = 'results:{"combine": "or", "genes": ["fake01"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key(genes=['fake01'])
         results = [
             'chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+'
         ]
-        for res in results:
-            self.r.rpush(key, res)
+        self.store.write(key, results, 60)
 
         self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
         self.r.set('sessions:fake-uuid',
@@ -680,6 +1487,100 @@ Called fake_store.llen(
         # TODO retest with mock
         # assert_same_trace(self.tt, expected_trace)
 
+    def test_get_result_paginated(self):
+        """Test get_result() only returns the requested page"""
+        key = 'results:fake_key'
+        results = ['row{0:03d}'.format(i) for i in range(250)]
+        self.store.write(key, results, 60)
+        self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid?offset=200&limit=20')
+        self.assertEqual(rv.json['results'], results[200:220])
+        self.assertEqual(rv.json['total_results'], 250)
+        self.assertEqual(rv.json['next_offset'], 220)
+        self.assertTrue(rv.json['more_results'])
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid/240')
+        self.assertEqual(rv.json['results'], results[240:])
+        self.assertFalse(rv.json['more_results'])
+
+    def test_get_result_running(self):
+        """Test get_result() serves the rows of a running analysis"""
+        key = 'results:fake_key'
+        results = ['row{0:04d}'.format(i) for i in range(1500)]
+        writer = self.store.writer(key, 60)
+        writer.append(results)
+        self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
+
+        rv = self.client.get('/api/v1.0/result/fake-uuid')
+        self.assertEqual(rv.json['state'], 'running')
+        self.assertEqual(rv.json['results'], results[:100])
+        self.assertEqual(rv.json['total_results'], 1000)
+        self.assertTrue(rv.json['more_results'])
+        self.assertNotIn('message', rv.json)
+
+        # the rows stored so far, but more are to come
+        rv = self.client.get('/api/v1.0/result/fake-uuid?offset=900')
+        self.assertEqual(rv.json['results'], results[900:1000])
+        self.assertTrue(rv.json['more_results'])
+
+        writer.close()
+        rv = self.client.get('/api/v1.0/result/fake-uuid?offset=1400')
+        self.assertEqual(rv.json['state'], 'done')
+        self.assertEqual(rv.json['results'], results[1400:])
+
+    def test_search_combines_cached_sets(self):
+        """Test search() combines cached set A and set B results"""
+        self.r.set('sessions:fake-uuid',
+                   json.dumps(dict(uuid='fake-uuid', state='done')))
+        self.store.write(_query_key(), ['row_a'], 60)
+        self.store.write(_query_key(set_a=['fake01']), ['row_b'], 60)
+        key_pending = '{0}_pending'.format(
+            _query_key(set_b=['fake01'], combine='and'))
+
+        data = dict(match_a='any', assembly='hg19', uuid='fake-uuid',
+                    combinatorial_op='and')
+        data['set_a[]'] = ['scifi']
+        data['set_b[]'] = ['fake01']
+        rv = self.client.post('/api/v1.0/search', data=data)
+
+        self.assertEqual(rv.json, dict(uuid='fake-uuid', state="pending"))
+        self.assertTrue(self.r.exists(key_pending))
+        self.assertIn('combine_results', str(self.tt.dump()))
+
+    def test_search_joins_pending_job(self):
+        """Test identical searches enqueue a single job"""
+        for unique_id in ('fake-uuid', 'other-uuid'):
+            self.r.set('sessions:' + unique_id,
+                       json.dumps(dict(uuid=unique_id, state='done')))
+        key_pending = '{0}_pending'.format(_query_key())
+
+        for unique_id in ('fake-uuid', 'other-uuid'):
+            data = dict(match_a='any', assembly='hg19', uuid=unique_id)
+            data['set_a[]'] = ['scifi']
+            rv = self.client.post('/api/v1.0/search', data=data)
+            self.assertEqual(rv.json, dict(uuid=unique_id, state="pending"))
+
+        self.assertEqual(self.r.get(key_pending), 'fake-uuid')
+        self.assertGreater(self.r.ttl(key_pending), 30)
+        self.assertEqual(self.r.smembers(run.waiters_key(key_pending)),
+                         {'fake-uuid', 'other-uuid'})
+        self.assertEqual(str(self.tt.dump()).count('Queue.enqueue'), 1)
+
+    def test_job_queue(self):
+        """Test jobs are queued by their estimated cost"""
+        query = dict(genes=['all'], set_a=['scifi'], set_b=None)
+        self.assertEqual(webdorina._job_queue(run.filter_genes, query),
+                         'fast')
+        self.assertEqual(webdorina._job_queue(run.run_analyse, query),
+                         'default')
+        query['set_b'] = ['fake01']
+        self.assertEqual(webdorina._job_queue(run.run_analyse, query),
+                         'heavy')
+        query['genes'] = ['gene01.01']
+        self.assertEqual(webdorina._job_queue(run.run_analyse, query),
+                         'default')
+
     def test_status(self):
         '''Test status()'''
         got = self.client.get('/api/v1.0/status/invalid')
@@ -691,14 +1592,111 @@ Called fake_store.llen(
         valid['ttl'] = self.r.ttl('sessions:valid')
         self.assertEqual(got.json, valid)
 
+    def test_list_genomes_cached(self):
+        """Test the genome list is served with an ETag"""
+        got = self.client.get('/api/v1.0/genomes')
+        self.assertEqual(got.status_code, 200)
+        self.assertIn('genomes', got.json)
+        etag = got.headers['ETag']
+        self.assertIn('max-age', got.headers['Cache-Control'])
+
+        got = self.client.get('/api/v1.0/genomes',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(got.status_code, 304)
+
+        got = self.client.get('/api/v1.0/assemblies/invalid')
+        self.assertEqual(got.json, dict(assemblies=[]))
+
+    def test_status_stream_done(self):
+        """Test status_stream() ends with a final state"""
+        valid = dict(uuid='valid', state='done')
+        self.r.set('sessions:valid', json.dumps(valid))
+        got = self.client.get('/api/v1.0/status/valid/stream')
+
+        self.assertEqual(got.mimetype, 'text/event-stream')
+        events = [line[len('data: '):] for line in
+                  got.data.decode('utf8').splitlines()
+                  if line.startswith('data: ')]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(json.loads(events[0])['state'], 'done')
+
     def test_genes(self):
         """Test list_genes()"""
-        expected = dict(genes=['gene01.01', 'gene01.02'])
-        fakeredis.FakeRedis.zrangebylex = Mock(
-            'zrangebylex', returns=['gene01.01', 'gene01.02'], tracker=self.tt)
-        got = self.client.get('/api/v1.0/genes/hg19')
+        self.r.zadd('genes:hg19', dict.fromkeys(
+            ['gene01.01', 'gene01.02', 'ABC1', 'XABC', 'ABC'], 0))
+        webdorina.gene_search.clear()
+
+        got = self.client.get('/api/v1.0/genes/hg19/gene01')
+        self.assertEqual(got.json, dict(genes=['gene01.01', 'gene01.02']))
+
+        # exact before prefix before substring matches
+        got = self.client.get('/api/v1.0/genes/hg19/abc')
+        self.assertEqual(got.json, dict(genes=['ABC', 'ABC1', 'XABC']))
+
+        got = self.client.get('/api/v1.0/genes/hg19/abc?limit=1')
+        self.assertEqual(got.json, dict(genes=['ABC']))
+
+    def test_gene_index_aliases(self):
+        """Test GeneIndex matches aliases"""
+        index = GeneIndex(['ELAVL1', 'TP53'], dict(ELAVL1=['HuR']))
+        self.assertEqual(index.search('hur', 10), ['ELAVL1'])
+        self.assertEqual(index.search('', 10), ['ELAVL1', 'TP53'])
+
+    def test_gene_index_short_queries(self):
+        """Test GeneIndex finds substrings of one or two letters"""
+        index = GeneIndex(['ABC', 'XAB', 'TP53'])
+        self.assertEqual(index.search('ab', 10), ['ABC', 'XAB'])
+        self.assertEqual(index.search('p', 10), ['TP53'])
+
+    def test_gene_search_rebuilt(self):
+        """Test the search index is reloaded after the gene index is built"""
+        webdorina.gene_search.clear()
+        mock('webdorina.Genome.get_genes', tracker=None,
+             returns=['gene01.01'])
+        got = self.client.get('/api/v1.0/genes/hg19/gene')
+        self.assertEqual(got.json, dict(genes=['gene01.01']))
 
-        self.assertEqual(got.json, expected)
+        restore()
+        mock('webdorina.Genome.get_genes', tracker=None,
+             returns=['gene01.01', 'gene01.02'])
+        self.assertTrue(webdorina.build_gene_index('hg19'))
+        got = self.client.get('/api/v1.0/genes/hg19/gene')
+        self.assertEqual(got.json, dict(genes=['gene01.01', 'gene01.02']))
+
+    def test_build_gene_index(self):
+        """Test build_gene_index() loads the genes in batches"""
+        mock('webdorina.Genome.get_genes', tracker=None,
+             returns=['gene01.02', 'gene01.01', 'gene01.03'])
+        batch_size = self.app.config['GENES_BATCH_SIZE']
+        self.app.config['GENES_BATCH_SIZE'] = 2
+        self.addCleanup(self.app.config.__setitem__, 'GENES_BATCH_SIZE',
+                        batch_size)
+
+        self.assertTrue(webdorina.build_gene_index('hg19'))
+        self.assertEqual(self.r.zrange('genes:hg19', 0, -1),
+                         ['gene01.01', 'gene01.02', 'gene01.03'])
+        self.assertFalse(self.r.exists('genes:hg19_building'))
+        self.assertFalse(self.r.exists('genes:hg19_lock'))
+
+    def test_warm_gene_indexes(self):
+        """Test warm_gene_indexes() builds the indexes outside the CLI"""
+        mock('webdorina.Genome.get_genes', tracker=None,
+             returns=['gene01.01'])
+        catalogue = webdorina.catalogue
+        webdorina.catalogue = dict(catalogue, assembly_ids=['hg19'])
+        self.addCleanup(setattr, webdorina, 'catalogue', catalogue)
+        webdorina.gene_search.clear()
+
+        reports = []
+        webdorina.warm_gene_indexes(reports.append)
+        self.assertEqual(reports, ['indexed genes of hg19'])
+        self.assertEqual(self.r.zrange('genes:hg19', 0, -1), ['gene01.01'])
+
+    def test_build_gene_index_locked(self):
+        """Test build_gene_index() leaves a locked index alone"""
+        self.r.set('genes:hg19_lock', 1)
+        self.assertFalse(webdorina.build_gene_index('hg19'))
+        self.assertFalse(self.r.exists('genes:hg19'))
 
     def test_download_regulator(self):
         """Test download_regulator()"""
@@ -721,20 +1719,34 @@ Called fake_store.llen(
         got = self.client.get('/api/v1.0/download/results/invalid')
         self.assertEqual(got.status_code, 404)
 
-        key = 'results:{"combine": "or", "genes": ["all"], "genome": "hg19", '
-        key += '"match_a": "any", "match_b": "any", "region_a": "any", '
-        key += '"region_b": "any", "set_a": ["scifi"], "set_b": null}'
+        key = _query_key()
         res = ['chr1	doRiNA2	gene	1	1000	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	6	+	250	260',
         ]
 
-        self.r.rpush(key, res)
+        self.store.write(key, res, 60)
         self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
 
         got = self.client.get('/api/v1.0/download/results/fake-uuid')
 
-        expected = "{}\n".format(res)
+        expected = "{}\n".format(res[0])
         self.assertEqual(got.data.decode('utf8'), expected)
 
+    def test_download_results_gzip(self):
+        """Test download_results() with on the fly compression"""
+        key = 'results:fake_key'
+        results = ['row{0}'.format(i) for i in range(12)]
+        self.store.write(key, results, 60)
+        self.r.set('results:sessions:fake-uuid', json.dumps(dict(redirect=key)))
+
+        got = self.client.get(
+            '/api/v1.0/download/results/fake-uuid?compress=gzip')
+
+        self.assertEqual(got.status_code, 200)
+        self.assertIn('carina_fake-uuid.txt.gz',
+                      got.headers['Content-Disposition'])
+        expected = ''.join(r + '\n' for r in results)
+        self.assertEqual(gzip.decompress(got.data).decode('utf8'), expected)
+
     def test_dict_to_bed(self):
         """Test _dict_to_bed()"""
         data = {'data_source': 'PARCLIP', 'score': 1000, 'track': 'scifi_hg19',
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Tissue to gene maps of the assemblies.
+
+`{DATA_PATH}/{assembly}_tissues.json` maps tissue names to gene lists.
+Parsed maps are kept in process and reloaded when the file changes.
+When a `{assembly}_tissues.sqlite` index built with
+
+    python -m webdorina.tissues DATA_PATH ASSEMBLY [ASSEMBLY ...]
+
+is at least as recent as the JSON file, lookups read the single tissue
+they need from it instead of parsing the whole JSON file. The genes of
+the last GENES_CACHE_SIZE tissues looked up in an index are kept in
+process until the index changes.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+GENES_CACHE_SIZE = 256
+
+_maps = {}
+_names = {}
+# (index path, tissue) -> (index mtime, genes), least recently used first
+_genes = OrderedDict()
+_lock = threading.Lock()
+
+
+def _paths(data_path, assembly):
+    basename = os.path.join(data_path, '{}_tissues'.format(assembly))
+    return basename + '.json', basename + '.sqlite'
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _index(data_path, assembly):
+    """Path and mtime of an up to date sqlite index, or None"""
+    json_path, index_path = _paths(data_path, assembly)
+    index_mtime = _mtime(index_path)
+    if index_mtime is None:
+        return None
+    json_mtime = _mtime(json_path)
+    if json_mtime is not None and json_mtime > index_mtime:
+        return None
+    return index_path, index_mtime
+
+
+def _tissue_map(data_path, assembly):
+    """The parsed JSON tissue map, reloaded when the file changes"""
+    json_path = _paths(data_path, assembly)[0]
+    mtime = os.path.getmtime(json_path)
+    cached = _maps.get(json_path)
+    if cached is None or cached[0] != mtime:
+        with _lock:
+            cached = _maps.get(json_path)
+            if cached is None or cached[0] != mtime:
+                with open(json_path) as open_f:
+                    genes_p_tissue = json.load(open_f)
+                cached = (mtime, tuple(genes_p_tissue), genes_p_tissue)
+                _maps[json_path] = cached
+    return cached
+
+
+def names(data_path, assembly):
+    """Names of the tissues of an assembly"""
+    index = _index(data_path, assembly)
+    if index is None:
+        return list(_tissue_map(data_path, assembly)[1])
+
+    cached = _names.get(index)
+    if cached is None:
+        with closing(sqlite3.connect(index[0])) as db:
+            cached = tuple(row[0] for row in db.execute(
+                'SELECT name FROM tissues ORDER BY position'))
+        _names[index] = cached
+    return list(cached)
+
+
+def genes(data_path, assembly, tissue):
+    """Genes expressed in a tissue, None for an unknown tissue"""
+    index = _index(data_path, assembly)
+    if index is None:
+        return _tissue_map(data_path, assembly)[2].get(tissue)
+
+    key = (index[0], tissue)
+    with _lock:
+        cached = _genes.get(key)
+        if cached is not None and cached[0] == index[1]:
+            _genes.move_to_end(key)
+            return None if cached[1] is None else list(cached[1])
+
+    with closing(sqlite3.connect(index[0])) as db:
+        row = db.execute('SELECT genes FROM tissues WHERE name = ?',
+                         (tissue,)).fetchone()
+    tissue_genes = None if row is None else tuple(json.loads(row[0]))
+    with _lock:
+        _genes[key] = (index[1], tissue_genes)
+        _genes.move_to_end(key)
+        while len(_genes) > GENES_CACHE_SIZE:
+            _genes.popitem(last=False)
+    return None if tissue_genes is None else list(tissue_genes)
+
+
+def build_index(data_path, assembly):
+    """Write the sqlite index of the JSON tissue map of an assembly"""
+    json_path, index_path = _paths(data_path, assembly)
+    with open(json_path) as open_f:
+        genes_p_tissue = json.load(open_f)
+
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute('CREATE TABLE tissues (name TEXT PRIMARY KEY, '
+                   'position INTEGER, genes TEXT)')
+        db.executemany('INSERT INTO tissues VALUES (?, ?, ?)', (
+            (name, position, json.dumps(tissue_genes))
+            for position, (name, tissue_genes)
+            in enumerate(genes_p_tissue.items())))
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index tissue maps for single tissue lookups')
+    parser.add_argument('data_path')
+    parser.add_argument('assemblies', nargs='+')
+    args = parser.parse_args()
+    for assembly in args.assemblies:
+        print('wrote {}'.format(build_index(args.data_path, assembly)))
+
+
+if __name__ == "__main__":
+    main()
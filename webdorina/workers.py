@@ -4,25 +4,416 @@
 Created on 15:57 18/01/2018 2018 
 
 """
+import glob
 import json
 import logging
+import multiprocessing
+import os
+import time
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from dorina import run
+from dorina.regulator import Regulator
 from redis import Redis
+from rq import Worker
+
+from webdorina import sites
+from webdorina.results import gene_index_key, make_store, sub_queries
 
 logger = logging.getLogger('app')
 
+# long lived objects shared by the jobs of a worker process, rq work horses
+# inherit whatever the worker loaded before forking
+_engines = {}
+_connections = {}
+_stores = {}
+# genes by chromosome of the assemblies, see gene_spans()
+_gene_spans = {}
+
+# the row dorina returns for a query without results
+NO_RESULTS = 'No results found'
+NO_RESULTS_ROW = '\t' * 8 + NO_RESULTS
+
+
+def get_dorina(datadir, tissue=None):
+    """Return the Dorina engine for a data dir and tissue extension"""
+    key = (datadir, tissue)
+    if key not in _engines:
+        start = time.time()
+        if tissue:
+            _engines[key] = run.Dorina(datadir, ext=tissue)
+        else:
+            _engines[key] = run.Dorina(datadir)
+        logger.info('Loaded dorina engine for {} in {:.2f}s'.format(
+            key, time.time() - start))
+    return _engines[key]
+
+
+def _redis(decode_responses=True):
+    """Return the shared Redis client, it pools its own connections"""
+    if decode_responses not in _connections:
+        if decode_responses:
+            _connections[decode_responses] = Redis(decode_responses=True)
+        else:
+            _connections[decode_responses] = Redis()
+    return _connections[decode_responses]
+
+
+def _result_store(backend, path):
+    if (backend, path) not in _stores:
+        _stores[backend, path] = make_store(_redis(False), backend, path)
+    return _stores[backend, path]
+
+
+def preload(datadir, tissues=()):
+    """Load the engines and connections before the first job arrives"""
+    get_dorina(datadir)
+    for tissue in tissues:
+        get_dorina(datadir, tissue)
+    _redis().ping()
+    _redis(False)
+
+
+class DorinaWorker(Worker):
+    """rq worker preloading dorina before it starts taking jobs
+
+    Run it with `rq worker -w webdorina.workers.DorinaWorker`. The data
+    dir defaults to DATA_PATH from webdorina/config.py and can be set
+    with WEBDORINA_DATA_PATH, tissue extensions to preload with a comma
+    separated WEBDORINA_TISSUES.
+    """
+
+    def work(self, *args, **kwargs):
+        from webdorina import config
+        datadir = os.environ.get('WEBDORINA_DATA_PATH', config.DATA_PATH)
+        tissues = [t for t in os.environ.get(
+            'WEBDORINA_TISSUES', '').split(',') if t]
+        preload(datadir, tissues)
+        return super(DorinaWorker, self).work(*args, **kwargs)
+
+
+def set_session_state(redis_store, uuid, state, ttl, **extra):
+    """Store the state of a session and publish it to its listeners"""
+    session = 'sessions:{0}'.format(uuid)
+    session_dict = json.dumps(dict(extra, state=state, uuid=uuid))
+    redis_store.setex(name=session, value=session_dict, time=ttl)
+    redis_store.publish(session, session_dict)
+
+
+def waiters_key(query_pending_key):
+    return "{0}_waiters".format(query_pending_key)
+
+
+def finish_job(redis_store, query_key, query_pending_key, uuid, state, ttl):
+    """Point the sessions waiting for query_key at its result
+
+    Called once the result is stored. The waiting sessions are drained
+    and the pending marker dropped in one transaction, see
+    webdorina.app._join_job.
+    """
+    waiters = waiters_key(query_pending_key)
+    pipe = redis_store.pipeline()
+    pipe.smembers(waiters)
+    pipe.delete(waiters, query_pending_key)
+    _notify(redis_store, query_key, pipe.execute()[0], uuid, state, ttl)
+
+
+def report_progress(redis_store, query_key, query_pending_key, uuid, rows,
+                    ttl):
+    """Point the sessions waiting for query_key at its partial result"""
+    waiting = redis_store.smembers(waiters_key(query_pending_key))
+    _notify(redis_store, query_key, waiting, uuid, 'running', ttl, rows=rows)
+
+
+def _notify(redis_store, query_key, waiting, uuid, state, ttl, **extra):
+    sessions = set(waiting)
+    sessions.add(uuid)
+    redirect = json.dumps(dict(redirect=query_key))
+    for session in sorted(sessions):
+        redis_store.setex(name='results:sessions:{0}'.format(session),
+                          value=redirect, time=ttl)
+        set_session_state(redis_store, session, state, ttl, **extra)
+
+
+def _gene_ids(row):
+    """Return the gene IDs annotated in a dorina result row"""
+    cols = row.split('\t')
+    if len(cols) < 9:
+        return []
+    ids = []
+    for field in cols[8].split(';'):
+        key, _, val = field.partition('=')
+        if key == 'ID':
+            ids.append(val)
+    return ids
+
+
+def gene_offsets(lines):
+    """Gene index of a result, each gene ID with the offsets of its rows"""
+    offsets = defaultdict(list)
+    for i, line in enumerate(lines):
+        for gene in _gene_ids(line):
+            offsets[gene].append(str(i))
+    return dict((gene, ','.join(rows)) for gene, rows in offsets.items())
+
+
+def _gene_intervals(rows):
+    """Merged gene intervals of a result by chromosome"""
+    by_chrom = defaultdict(list)
+    for row in rows:
+        cols = row.split('\t')
+        if len(cols) < 9:
+            continue
+        by_chrom[cols[0]].append((int(cols[3]), int(cols[4])))
+
+    merged = {}
+    for chrom, intervals in by_chrom.items():
+        intervals.sort()
+        starts, ends = [], []
+        for start, end in intervals:
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        merged[chrom] = (starts, ends)
+    return merged
+
+
+def _overlaps(row, intervals):
+    """Whether the gene of a result row overlaps any of the intervals"""
+    cols = row.split('\t')
+    if len(cols) < 9 or cols[0] not in intervals:
+        return False
+    starts, ends = intervals[cols[0]]
+    i = bisect_right(starts, int(cols[4])) - 1
+    return i >= 0 and ends[i] >= int(cols[3])
+
+
+def combine_rows(rows_a, rows_b, combine):
+    """Combine the results of set A and set B like dorina.analyse does
+
+    Rows are matched on their gene feature, as dorina intersects the
+    gene intervals of both results.
+    """
+    if combine == 'or':
+        return list(rows_a) + list(rows_b)
+
+    genes_b = _gene_intervals(rows_b)
+    if combine == 'and':
+        return [row for row in rows_a if _overlaps(row, genes_b)]
+
+    only_a = [row for row in rows_a if row and not _overlaps(row, genes_b)]
+    if combine == 'not':
+        return only_a
+    elif combine == 'xor':
+        genes_a = _gene_intervals(rows_a)
+        return only_a + [row for row in rows_b
+                         if row and not _overlaps(row, genes_a)]
+    raise ValueError('Unknown combinatorial operation {0!r}'.format(combine))
+
+
+def _result_rows(result):
+    """Rows of a dorina result without blanks and the empty placeholder"""
+    return [row for row in str(result).splitlines()
+            if row.strip() and not row.endswith(NO_RESULTS)]
+
+
+def _analyse_rows(datadir, tissue, query):
+    """Rows dorina finds for a query, runs in the analysis pool"""
+    # parts are merged, so they don't keep the placeholder
+    return _result_rows(get_dorina(datadir, tissue).analyse(**query))
+
+
+def _match_rows(parts, match):
+    """Merge the rows found for the single regulators of a set
+
+    With match 'any' the rows of all regulators are kept, with 'all' only
+    the rows of genes every regulator has a site in.
+    """
+    if match != 'all':
+        return [row for rows in parts for row in rows]
+    genes = None
+    for rows in parts:
+        hit = set(gene for row in rows for gene in _gene_ids(row))
+        genes = hit if genes is None else genes & hit
+    return [row for rows in parts for row in rows
+            if any(gene in genes for gene in _gene_ids(row))]
+
+
+def split_query(query):
+    """Single regulator queries of set A and, if given, set B
+
+    Returns the match mode and the queries of each set.
+    """
+    sets = (query,) if query['set_b'] is None else sub_queries(query)
+    return [(sub_query.get('match_a', 'any'),
+             [dict(sub_query, set_a=[regulator])
+              for regulator in sub_query['set_a']])
+            for sub_query in sets]
+
+
+def gene_spans(datadir, genome):
+    """Genes of an assembly as (ID, start, end) by chromosome
+
+    Chromosomes are in all.gff order.
+    """
+    key = (datadir, genome)
+    if key not in _gene_spans:
+        by_chrom = OrderedDict()
+        pattern = os.path.join(datadir, 'genomes', '*', genome, 'all.gff')
+        for path in sorted(glob.glob(pattern))[:1]:
+            with open(path) as gff:
+                for line in gff:
+                    line = line.rstrip('\n')
+                    cols = line.split('\t')
+                    for gene in _gene_ids(line):
+                        by_chrom.setdefault(cols[0], []).append(
+                            (gene, int(cols[3]), int(cols[4])))
+        _gene_spans[key] = list(by_chrom.items())
+    return _gene_spans[key]
+
+
+def chromosome_genes(datadir, genome):
+    """Gene IDs of an assembly grouped by chromosome, in all.gff order"""
+    return [(chrom, [gene for gene, _, _ in genes])
+            for chrom, genes in gene_spans(datadir, genome)]
+
+
+def _site_indexes(query):
+    """Site indexes of the regulators of a query, None unless all have one"""
+    indexes = []
+    for regulator in query['set_a'] + (query['set_b'] or []):
+        try:
+            path = Regulator.from_name(regulator, query['genome']).path
+        except Exception:
+            # custom regulators have no index
+            return None
+        index = sites.load(path)
+        if index is None:
+            return None
+        indexes.append(index)
+    return indexes
+
+
+def group_shards(shards, count):
+    """Merge consecutive shards into at most count of similar size"""
+    if len(shards) <= count:
+        return shards
+    total = sum(len(shard) for shard in shards)
+    groups = [[]]
+    done = 0
+    for shard in shards:
+        if groups[-1] and done >= total * len(groups) / count:
+            groups.append([])
+        groups[-1].extend(shard)
+        done += len(shard)
+    return groups
+
+
+def genome_shards(datadir, query, count=None):
+    """Gene IDs to analyse for a genome-wide query, by chromosome
+
+    When all regulators of the query have a site index, genes without a
+    site within the query's windows are left out, they can't have
+    results, and so are chromosomes without any gene left. Each shard is
+    a dorina call parsing the whole all.gff and regulator BED files, so
+    given a count, chromosomes are grouped into at most count shards.
+    Returns None when the genes of the assembly are unknown, intergenic
+    regions, which aren't genes, are searched, or a single shard would
+    hold all genes.
+    """
+    if 'intergenic' in (query.get('region_a'), query.get('region_b')):
+        return None
+    spans = gene_spans(datadir, query['genome'])
+    if not spans:
+        return None
+    indexes = _site_indexes(query)
+    if indexes is None:
+        if count == 1:
+            return None
+        shards = [[gene for gene, _, _ in genes] for _, genes in spans]
+    else:
+        window = max(query.get('window_a', 0), query.get('window_b', 0), 0)
+        shards = []
+        for chrom, genes in spans:
+            starts = [start - window for _, start, _ in genes]
+            ends = [end + window for _, _, end in genes]
+            hits = sum(index.count(chrom, starts, ends) for index in indexes)
+            kept = [gene for (gene, _, _), hit in zip(genes, hits) if hit]
+            if kept:
+                shards.append(kept)
+    return shards if count is None else group_shards(shards, count)
+
+
+def iter_analyse(datadir, query, processes=None, tissue=None, shards=None):
+    """Analyse a query in a process pool, yields the rows of each shard
+
+    Every set is split into single regulator queries and, given shards
+    of gene IDs, each of those into one query per shard. Rows are merged
+    per shard and set according to the match mode, set A and set B are
+    combined with combine_rows(), and the shards are yielded in order.
+    Both steps work gene by gene, so chromosome shards add up to the
+    genome-wide result. Pool processes are forked, so they share the
+    engines the worker loaded.
+    """
+    sets = split_query(query)
+    shards = shards or [None]
+    num_parts = len(shards) * sum(len(parts) for _, parts in sets)
+    processes = min(processes or os.cpu_count(), num_parts)
+    with ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [[(match, [pool.submit(_analyse_rows, datadir, tissue,
+                                         part if genes is None
+                                         else dict(part, genes=genes))
+                             for part in parts])
+                    for match, parts in sets]
+                   for genes in shards]
+        for shard in futures:
+            merged = [_match_rows([future.result() for future in parts], match)
+                      for match, parts in shard]
+            if len(merged) == 1:
+                yield merged[0]
+            else:
+                yield combine_rows(merged[0], merged[1],
+                                   query.get('combine', 'or'))
+
+
+def iter_analyse_serial(dorina, query):
+    """Analyse a query in this process, yields rows as they are found
+
+    A single set matching any of its regulators is analysed regulator by
+    regulator, so the rows of the first ones can be shown while the
+    others run. Other queries take a single dorina call.
+    """
+    if query['set_b'] is None and query.get('match_a', 'any') == 'any':
+        for regulator in query['set_a']:
+            yield _result_rows(dorina.analyse(**dict(query,
+                                                     set_a=[regulator])))
+    else:
+        yield _result_rows(dorina.analyse(**query))
+
+
+def analyse_parallel(datadir, query, processes=None, tissue=None,
+                     shards=None):
+    """Rows of a query analysed in a process pool, see iter_analyse()"""
+    return [row for rows in iter_analyse(datadir, query, processes, tissue,
+                                         shards)
+            for row in rows]
+
 
 def run_analyse(datadir, query_key, query_pending_key, query, uuid,
                 SESSION_STORE=None, RESULT_TTL=None, SESSION_TTL=None,
-                tissue=None):
+                tissue=None, RESULT_BACKEND='redis', RESULT_PATH=None,
+                PROCESSES=1):
     logger.info('Running analysis for {}'.format(query_key))
-    if tissue:
-        dorina = run.Dorina(datadir, ext=tissue)
-    else:
-        dorina = run.Dorina(datadir)
-
-    redis_store = Redis(charset="utf-8", decode_responses=True)
+    start = time.time()
+    dorina = get_dorina(datadir, tissue)
+    redis_store = _redis()
+    store = _result_store(RESULT_BACKEND, RESULT_PATH)
+    logger.debug('Job setup took {:.3f}s'.format(time.time() - start))
 
     session_store = SESSION_STORE.format(unique_id=uuid)
     custom_regulator_file = '{session_store}/{uuid}.bed'.format(
@@ -43,55 +434,114 @@ def run_analyse(datadir, query_key, query_pending_key, query, uuid,
             else:
                 set_b.append(regulator)
         query['set_b'] = set_b
+    state = 'done'
     try:
         logger.debug('Storing analysis result for {}'.format(query_key))
-        result = str(dorina.analyse(**query))
-        lines = result.splitlines()
-        logger.debug("returning {} rows".format(len(lines)))
-        redis_store.rpush(query_key, *lines)
-        redis_store.setex('results:sessions:{0}'.format(uuid), json.dumps(dict(
-            redirect=query_key)), SESSION_TTL)
+        regulators = len(query['set_a']) + len(query['set_b'] or [])
+        shards = None
+        if PROCESSES != 1 and query.get('genes') == [u'all']:
+            # genome-wide queries run in groups of chromosomes, as many as
+            # there are processes left for each regulator
+            shards = genome_shards(
+                datadir, query,
+                max((PROCESSES or os.cpu_count()) // regulators, 1))
+        if shards == []:
+            # no regulator has a site near any gene
+            parts = []
+        elif PROCESSES != 1 and (shards or regulators > 1):
+            parts = iter_analyse(datadir, query, PROCESSES, tissue, shards)
+        else:
+            parts = iter_analyse_serial(dorina, query)
+
+        # store the rows of every finished part right away
+        lines = []
+        writer = store.writer(query_key, RESULT_TTL)
+        visible = 0
+        part_start = time.time()
+        for rows in parts:
+            logger.debug('Part of {} rows took {:.3f}s'.format(
+                len(rows), time.time() - part_start))
+            part_start = time.time()
+            lines.extend(rows)
+            if writer.append(rows) > visible:
+                visible = writer.rows
+                report_progress(redis_store, query_key, query_pending_key,
+                                uuid, visible, SESSION_TTL)
+        if not lines:
+            lines = [NO_RESULTS_ROW]
+            writer.append(lines)
+        # gene filters of all genes results look their rows up in the index
+        writer.close(gene_offsets(lines)
+                     if query.get('genes') == [u'all'] else None)
+        logger.debug("stored {} rows".format(len(lines)))
     except Exception as e:
         result = 'Job failed: %s' % str(e)
-        redis_store.setex('sessions:{0}'.format(uuid), json.dumps(dict(
-            state='error', uuid=uuid)), SESSION_TTL)
-        redis_store.rpush(query_key, result)
+        state = 'error'
+        store.write(query_key, [result], RESULT_TTL)
 
-    redis_store.expire(query_key, RESULT_TTL)
-    redis_store.setex('sessions:{0}'.format(uuid), json.dumps(dict(
-        state='done', uuid=uuid)), SESSION_TTL)
-    redis_store.delete(query_pending_key)
+    finish_job(redis_store, query_key, query_pending_key, uuid, state,
+               SESSION_TTL)
+    logger.info('Analysis for {} took {:.2f}s'.format(
+        query_key, time.time() - start))
 
 
 def filter_genes(genes, full_query_key, query_key, query_pending_key, uuid,
-                 session_ttl=None, result_ttl=None):
+                 session_ttl=None, result_ttl=None, result_backend='redis',
+                 result_path=None):
     """Filter for a given set of gene names"""
-    redis_store = Redis(charset="utf-8", decode_responses=True)
+    redis_store = _redis()
+    store = _result_store(result_backend, result_path)
 
-    full_results = redis_store.lrange(full_query_key, 0, -1)
-    results = []
-    for res_string in full_results:
-        if res_string == '':
-            continue
-        cols = res_string.split('\t')
-        annotations = cols[8]
-        for field in annotations.split(';'):
-            key, val = field.split('=')
-            if key == 'ID' and val in genes:
-                results.append(res_string)
-
-    num_results = len(results)
-    if num_results:
-        for i in range(0, num_results, 1000):
-            res = results[i:i + 1000]
-            redis_store.rpush(query_key, *res)
-    else:
-        redis_store.rpush(query_key, [])
+    state = 'done'
+    try:
+        index_key = gene_index_key(full_query_key)
+        if redis_store.exists(index_key):
+            # only decompress the blocks holding rows listed in the index
+            offsets = set()
+            for hit in redis_store.hmget(index_key, genes):
+                if hit:
+                    offsets.update(int(offset) for offset in hit.split(','))
+            results = [row for row in
+                       store.rows(full_query_key, sorted(offsets)) if row]
+        else:
+            genes = set(genes)
+            results = []
+            for rows in store.iter_rows(full_query_key):
+                for res_string in rows:
+                    if res_string == '':
+                        continue
+                    if any(gene in genes for gene in _gene_ids(res_string)):
+                        results.append(res_string)
+    except Exception as e:
+        results = ['Job failed: %s' % str(e)]
+        state = 'error'
+
+    store.write(query_key, results, result_ttl)
+    finish_job(redis_store, query_key, query_pending_key, uuid, state,
+               session_ttl)
 
-    redis_store.expire(query_key, result_ttl)
-    redis_store.delete(query_pending_key)
 
-    redis_store.setex('sessions:{0}'.format(uuid), json.dumps(dict(
-        state='done', uuid=uuid)), session_ttl)
-    redis_store.setex('results:sessions:{0}'.format(uuid), json.dumps(dict(
-        redirect=query_key)), session_ttl)
+def combine_results(combine, key_a, key_b, query_key, query_pending_key, uuid,
+                    session_ttl=None, result_ttl=None, result_backend='redis',
+                    result_path=None, genome_wide=False):
+    """Combine the cached results of set A and set B
+
+    The result of a genome_wide query gets a gene index like the ones
+    of run_analyse().
+    """
+    redis_store = _redis()
+    store = _result_store(result_backend, result_path)
+
+    state = 'done'
+    index = None
+    try:
+        rows = combine_rows(store.read(key_a), store.read(key_b), combine)
+        if genome_wide:
+            index = gene_offsets(rows)
+    except Exception as e:
+        rows = ['Job failed: %s' % str(e)]
+        state = 'error'
+
+    store.write(query_key, rows, result_ttl, index)
+    finish_job(redis_store, query_key, query_pending_key, uuid, state,
+               session_ttl)